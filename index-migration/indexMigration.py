@@ -1,46 +1,343 @@
 import subprocess
+import os
+import argparse
+import threading
+import json
+import time
+from multiprocessing.pool import ThreadPool
+import pymongo
 
-def backup_db():
+MONGO_URI = 'mongodb://localhost:27017'
+DATABASE = 'pxe'
+INDEX_SPECS = 'index-specs.json'
+BACKUP_ARCHIVE = 'dump.bak.gz'
+# documents indexed per second for each index, used to estimate the rebuild time
+INDEX_RATE = 50000
+# index options compared when deciding whether an index has changed
+INDEX_OPTIONS = ['unique', 'sparse', 'expireAfterSeconds', 'partialFilterExpression']
+
+def backup_db(archive=BACKUP_ARCHIVE, uri=MONGO_URI, parallel=4):
     """
-    To backup mongo databases and save it to a directory called dump.bak
+    To backup mongo databases to a single gzip compressed archive,
+    mongodump streams the collections into it, parallel of them at the same time.
+    The previous archive is only replaced once the new one is verified
     """
-    try:
-        subprocess.check_output(['ls dump'], shell=True);
-        subprocess.check_call(['rm -rf dump*'], shell=True)
-    except CalledProcessError:
-        pass
-    subprocess.check_call(['mongodump'])
-    subprocess.check_call(['cp', '-rf', 'dump', 'dump.bak'])
-    subprocess.check_output(['ls dump.bak'], shell=True);
+    partial = archive + '.partial'
+    subprocess.check_call(['mongodump', '--uri', uri, '--gzip', '--archive=' + partial,
+                           '--numParallelCollections', str(max(1, parallel))])
+    verify_backup(partial, uri)
+    os.rename(partial, archive)
 
-def get_collection():
+def verify_backup(archive=BACKUP_ARCHIVE, uri=MONGO_URI):
+    """
+    To check the archive is complete, mongorestore reads it through without writing anything
+    """
+    assert os.path.isfile(archive) and os.path.getsize(archive) > 0, "The backup %s is not created" % archive
+    subprocess.check_call(['mongorestore', '--uri', uri, '--gzip', '--archive=' + archive, '--dryRun'])
+
+def get_database(uri=MONGO_URI, name=DATABASE):
+    """
+    To open one driver connection to the mongo database,
+    the client keeps a connection pool shared by all the threads
+    """
+    return pymongo.MongoClient(uri)[name]
+
+def get_collection(db):
     """
     To get collection names of mongo databases
     """
-    label1=subprocess.Popen(['mongo', 'pxe', '--eval', 'db.getCollectionNames()'], stdout=subprocess.PIPE)
-    collection_info =  label1.stdout.read().split('\n')
-    collection_names= collection_info[-2].split(',')
-    return collection_names
+    if hasattr(db, 'list_collection_names'):
+        return db.list_collection_names()
+    return db.collection_names(include_system_collections=False)
+
+def drop_collection_indexes(db, collection):
+    """
+    To delete the indexes of one collection
+    :return: a dictionary of the collection name, ok, the error message and the elapsed seconds
+    """
+    start = time.time()
+    result = {'collection': collection, 'ok': True, 'error': None}
+    try:
+        db[collection].drop_indexes()
+    except pymongo.errors.PyMongoError as error:
+        result['ok'] = False
+        result['error'] = str(error)
+    result['time'] = time.time() - start
+    return result
+
+def drop_indexes(db, parallel=4):
+    """
+    To delete all indexes, dropping the indexes of up to parallel collections at the same time
+    :return: the list of per-collection results, see drop_collection_indexes
+    """
+    collections = get_collection(db)
+    pool = ThreadPool(max(1, parallel))
+    try:
+        results = pool.map(lambda collection: drop_collection_indexes(db, collection), collections)
+    finally:
+        pool.close()
+        pool.join()
+    for result in results:
+        if result['ok']:
+            print "Dropped indexes of collection %s in %.3fs" % (result['collection'], result['time'])
+        else:
+            print "Failed to drop indexes of collection %s: %s" % (result['collection'], result['error'])
+    failed = [result['collection'] for result in results if not result['ok']]
+    assert not failed, "Error is found when dropping mongo database indexes from collection %s" % ", ".join(failed)
+    return results
+
+def normalize_index(index):
+    """
+    To reduce an index definition to its name, key and options,
+    the key is a list of [field, direction] pairs so that it keeps its order in JSON
+    """
+    key = index['key']
+    if hasattr(key, 'items'):
+        key = key.items()
+    spec = {'name': index['name'], 'key': [[field, direction] for field, direction in key]}
+    for option in INDEX_OPTIONS:
+        if option in index:
+            spec[option] = index[option]
+    return spec
+
+def get_index_specs(db):
+    """
+    To capture the index definitions of every collection, the _id index excluded
+    :return: a dictionary of collection name to the list of its normalized indexes
+    """
+    specs = {}
+    for collection in get_collection(db):
+        specs[collection] = [normalize_index(index) for index in db[collection].list_indexes()
+                             if index['name'] != '_id_']
+    return specs
+
+def save_index_specs(specs, path):
+    with open(path, 'w') as f:
+        json.dump(specs, f, sort_keys=True, indent=4)
+
+def load_index_specs(path):
+    """
+    To load a spec file, a dictionary of collection name to a list of indexes like
+    {"name": "uuid_1", "key": [["uuid", 1]], "unique": true}
+    """
+    with open(path) as f:
+        specs = json.load(f)
+    return dict((collection, [normalize_index(index) for index in indexes])
+                for collection, indexes in specs.items())
 
-def drop_indexes():
+def diff_index_specs(current, target):
+    """
+    To compare the captured indexes with the target ones
+    :return: a dictionary of collection name to a pair of the names of the indexes to drop
+             (removed or changed) and the specs of the indexes to build (new or changed),
+             collections whose indexes are unchanged are left out
+    """
+    plan = {}
+    for collection in set(current) | set(target):
+        existing = dict((index['name'], index) for index in current.get(collection, []))
+        wanted = dict((index['name'], index) for index in target.get(collection, []))
+        to_drop = sorted(name for name in existing if existing[name] != wanted.get(name))
+        to_build = [wanted[name] for name in sorted(wanted) if wanted[name] != existing.get(name)]
+        if to_drop or to_build:
+            plan[collection] = (to_drop, to_build)
+    return plan
+
+def count_documents(db, collection):
+    if hasattr(db[collection], 'estimated_document_count'):
+        return db[collection].estimated_document_count()
+    return db[collection].count()
+
+class RebuildProgress(object):
+    """
+    To report the progress of the index builds, the estimated time remaining assumes
+    the indexes are built at the same number of documents per second as the finished ones
     """
-    To delete all indexes
+    def __init__(self, total_indexes, total_documents):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.total_indexes = total_indexes
+        self.total_documents = total_documents
+        self.built_indexes = 0
+        self.built_documents = 0
+
+    def update(self, collection, name, documents):
+        with self.lock:
+            self.built_indexes += 1
+            self.built_documents += documents
+            elapsed = time.time() - self.start
+            remaining = self.total_documents - self.built_documents
+            if self.built_documents:
+                eta = "%.1fs" % (elapsed * remaining / self.built_documents)
+            else:
+                eta = "unknown"
+            print "Built index %s of collection %s (%d/%d indexes, %.1fs elapsed, ETA %s)" % \
+                  (name, collection, self.built_indexes, self.total_indexes, elapsed, eta)
+
+def rebuild_collection_indexes(db, collection, to_drop, to_build, progress):
+    """
+    To drop the removed or changed indexes of one collection and build the new ones
+    one after the other in the background, so the collection stays available
+    :return: a dictionary of the collection name, ok, the error message and the elapsed seconds
+    """
+    start = time.time()
+    result = {'collection': collection, 'ok': True, 'error': None,
+              'dropped': [], 'built': []}
+    try:
+        for name in to_drop:
+            db[collection].drop_index(name)
+            result['dropped'].append(name)
+        documents = count_documents(db, collection) if to_build else 0
+        for spec in to_build:
+            options = dict((option, spec[option]) for option in INDEX_OPTIONS if option in spec)
+            db[collection].create_index([tuple(pair) for pair in spec['key']], name=spec['name'],
+                                        background=True, **options)
+            result['built'].append(spec['name'])
+            progress.update(collection, spec['name'], documents)
+    except pymongo.errors.PyMongoError as error:
+        result['ok'] = False
+        result['error'] = str(error)
+    result['time'] = time.time() - start
+    return result
+
+def rebuild_indexes(db, target_path, capture_path=INDEX_SPECS, parallel=4):
     """
-    collections=get_collection()
-    errors = ['error', 'Error', 'ERROR']
-    for collection in collections:
-       drop_index_result = subprocess.Popen(['mongo', 'pxe', '--eval', 'db.'+collection+'.dropIndexes()'], stdout=subprocess.PIPE)
-       drop_index_output =  drop_index_result.stdout.read()
-       for error in errors:
-          assert error not in drop_index_output, "Error is found when dropping mongo database indexes from collection %s" % collection
+    To migrate the indexes to the target spec file: the current indexes are captured to
+    capture_path first, then only the new or changed indexes are rebuilt, up to parallel
+    collections at the same time
+    :return: the list of per-collection results, see rebuild_collection_indexes
+    """
+    current = get_index_specs(db)
+    save_index_specs(current, capture_path)
+    print "Captured the current indexes to %s" % capture_path
+    plan = diff_index_specs(current, load_index_specs(target_path))
+    if not plan:
+        print "The indexes already match %s" % target_path
+        return []
+    documents = dict((collection, count_documents(db, collection) if collection in current else 0)
+                     for collection in plan)
+    progress = RebuildProgress(sum(len(to_build) for to_drop, to_build in plan.values()),
+                               sum(documents[collection] * len(plan[collection][1]) for collection in plan))
+    pool = ThreadPool(max(1, parallel))
+    try:
+        results = pool.map(lambda collection: rebuild_collection_indexes(db, collection, plan[collection][0],
+                                                                         plan[collection][1], progress),
+                           sorted(plan))
+    finally:
+        pool.close()
+        pool.join()
+    for result in results:
+        if result['ok']:
+            print "Rebuilt collection %s in %.3fs, dropped %s, built %s" % \
+                  (result['collection'], result['time'], result['dropped'], result['built'])
+        else:
+            print "Failed to rebuild indexes of collection %s: %s" % (result['collection'], result['error'])
+    failed = [result['collection'] for result in results if not result['ok']]
+    assert not failed, "Error is found when rebuilding mongo database indexes of collection %s" % ", ".join(failed)
+    return results
+
+def collection_stats(db, collection):
+    """
+    To get the document count and the data and index sizes of one collection,
+    a stand-in server without collStats only gives the document count
+    """
+    try:
+        stats = db.command('collstats', collection)
+    except (pymongo.errors.OperationFailure, NotImplementedError):
+        stats = {'count': count_documents(db, collection)}
+    return {'count': stats.get('count', 0),
+            'size': stats.get('size', 0),
+            'totalIndexSize': stats.get('totalIndexSize', 0),
+            'indexSizes': dict(stats.get('indexSizes', {}))}
+
+def analyze_indexes(db, target_path=None, index_rate=INDEX_RATE):
+    """
+    To estimate the impact of the migration without changing anything: for every collection,
+    the document count, data size, index sizes and definitions, and the time to build the
+    indexes to rebuild, that is all of them, or the new or changed ones of target_path,
+    at index_rate documents per second for each index
+    :return: a dictionary of collection name to its analysis, and the total under the None key
+    """
+    current = get_index_specs(db)
+    if target_path:
+        plan = diff_index_specs(current, load_index_specs(target_path))
+        to_build = dict((collection, plan[collection][1]) for collection in plan)
+    else:
+        to_build = current
+    report = {}
+    for collection in sorted(current):
+        analysis = collection_stats(db, collection)
+        analysis['indexes'] = current[collection]
+        analysis['rebuild'] = [index['name'] for index in to_build.get(collection, [])]
+        analysis['estimate'] = float(analysis['count']) * len(analysis['rebuild']) / index_rate
+        report[collection] = analysis
+    report[None] = {'count': sum(report[c]['count'] for c in current),
+                    'size': sum(report[c]['size'] for c in current),
+                    'totalIndexSize': sum(report[c]['totalIndexSize'] for c in current),
+                    'rebuild': sum(len(report[c]['rebuild']) for c in current),
+                    'estimate': sum(report[c]['estimate'] for c in current)}
+    return report
+
+def print_analysis(report):
+    print "%-30s %12s %14s %14s %8s %10s" % ('collection', 'documents', 'data size', 'index size', 'rebuild', 'estimate')
+    for collection in sorted(c for c in report if c is not None):
+        analysis = report[collection]
+        print "%-30s %12d %14d %14d %8d %9.1fs" % (collection, analysis['count'], analysis['size'],
+                                                  analysis['totalIndexSize'], len(analysis['rebuild']),
+                                                  analysis['estimate'])
+        for index in analysis['indexes']:
+            print "    %s %s size=%d" % (index['name'], json.dumps(index['key']),
+                                         analysis['indexSizes'].get(index['name'], 0))
+    total = report[None]
+    print "%-30s %12d %14d %14d %8d %9.1fs" % ('total', total['count'], total['size'], total['totalIndexSize'],
+                                              total['rebuild'], total['estimate'])
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mongo-uri', default=MONGO_URI,
+                        help="The mongo server to connect, default: %s" % MONGO_URI)
+    parser.add_argument('--database', default=DATABASE,
+                        help="The RackHD database, default: %s" % DATABASE)
+    parser.add_argument('--parallel', type=int, default=4,
+                        help="The number of collections processed at the same time, default: 4")
+    parser.add_argument('--backup', default=BACKUP_ARCHIVE,
+                        help="The gzip compressed archive the databases are backed up to, default: %s" % BACKUP_ARCHIVE)
+    parser.add_argument('--target', default=None,
+                        help="A spec file of the wanted indexes, only the new or changed indexes are rebuilt\
+ instead of dropping all of them")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Only report the collections, their indexes and the estimated rebuild time,\
+ nothing is changed")
+    parser.add_argument('--index-rate', type=float, default=INDEX_RATE,
+                        help="The documents indexed per second for each index, default: %d" % INDEX_RATE)
+    parser.add_argument('--capture', default=INDEX_SPECS,
+                        help="The file the current indexes are captured to, default: %s" % INDEX_SPECS)
+    return parser.parse_args()
 
 def main():
     """
     To execute the index migration
     """
-    print "Warning! Execute this script will drop all indexes from mongo databases!\nYet the script will help you backup all mongo databases\
-in a directory called dump.save under your working directory.\nIf you were to restore your mongoDB after executing this script, \
-simpleyly run 'mongorestore dump.bak'.\nContinue running the script(Yes|No)?"
+    args = parse_args()
+    if args.dry_run:
+        print_analysis(analyze_indexes(get_database(args.mongo_uri, args.database), args.target, args.index_rate))
+        return
+    db = get_database(args.mongo_uri, args.database)
+    if args.target:
+        plan = diff_index_specs(get_index_specs(db), load_index_specs(args.target))
+        if not plan:
+            print "The indexes of database %s already match %s, nothing to do" % (args.database, args.target)
+            return
+        print "Warning! Execute this script will migrate the indexes of database %s to %s:" % (args.database, args.target)
+        for collection in sorted(plan):
+            to_drop, to_build = plan[collection]
+            print "  %s: drop %s, build %s" % (collection, ", ".join(to_drop) or "none",
+                                               ", ".join(index['name'] for index in to_build) or "none")
+    else:
+        print "Warning! Execute this script will drop all indexes (except _id) of all collections of database %s!" % \
+              args.database
+    print "Yet the script will help you backup all mongo databases \
+in an archive called %s under your working directory.\nIf you were to restore your mongoDB after executing this script, \
+simply run 'mongorestore --gzip --archive=%s'.\nContinue running the script(Yes|No)?" % (args.backup, args.backup)
     for attemp in range(3):
         user_input = raw_input()
         if user_input not in ['Yes', 'No']:
@@ -50,9 +347,14 @@ simpleyly run 'mongorestore dump.bak'.\nContinue running the script(Yes|No)?"
             print "The script is NOT executed!"
             break
         else:
-            backup_db()
-            drop_indexes()
-            print "The indexes are dropped successfully!"
+            backup_db(args.backup, args.mongo_uri, args.parallel)
+            if args.target:
+                rebuild_indexes(db, args.target, args.capture, args.parallel)
+                print "The indexes are rebuilt successfully!"
+            else:
+                save_index_specs(get_index_specs(db), args.capture)
+                drop_indexes(db, args.parallel)
+                print "The indexes are dropped successfully!"
             break
 
 if __name__ == '__main__':
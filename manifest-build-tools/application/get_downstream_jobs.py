@@ -15,17 +15,19 @@ build-url: the build URL of the job, such as http://rackhdci.lss.emc.com/job/on-
 
 The optional parameters: 
 parameter-file: The file with parameters. The file will be passed to downstream jobs.
+parallel: The number of builds fetched from jenkins concurrently, default: 8
 '''
 
 import json
-import requests
 import os
 import sys
 import argparse
 import re
+from multiprocessing.pool import ThreadPool
 
 try:
     import common
+    from httpclient import HttpClient
 except ImportError as import_err:
     print import_err
     sys.exit(1)
@@ -44,18 +46,32 @@ def parse_args(args):
                         help="The jenkins parameter file that will be used for Jenkins job",
                         action='store',
                         default="downstream_parameters")
+    parser.add_argument('--parallel',
+                        help="The number of builds fetched from jenkins concurrently",
+                        action='store',
+                        type=int,
+                        default=8)
 
     parsed_args = parser.parse_args(args)
     return parsed_args
 
-def get_build_data(build_url):
+# Only ask jenkins for the fields the walker needs, the full build json
+# of a multijob contains the whole change set and every action.
+SUB_BUILDS_TREE = "subBuilds[jobName,buildNumber,url]"
+
+def get_build_data(build_url, session=None):
     '''
     get the json data of a build
     :param build_url: the url of a build in jenkins
+    :param session: the HttpClient used to query jenkins,
+                    a new one is created if it's None
     :return: json data of the build if succeed to get the json data
              None if failed to get the json data
     '''
-    r = requests.get(build_url + "/api/json")
+    if session is None:
+        session = HttpClient()
+    url = build_url.rstrip("/") + "/api/json"
+    r = session.get(url, params={"tree": SUB_BUILDS_TREE})
     if is_error_response(r):
         print "Failed to get api json of {0}".format(build_url)
         print r.status_code
@@ -64,23 +80,46 @@ def get_build_data(build_url):
         data = r.json()
         return data
 
-def get_sub_builds(build_url, jenkins_url):
+def get_sub_builds(build_url, jenkins_url, parallel=8, session=None):
     '''
     get sub builds of a build
+    The build tree is walked breadth first: all the builds of one level are
+    fetched concurrently, and each build url is fetched only once even if
+    it's a sub build of several upstream builds.
     :param build_url: the url of a build in jenkins
+    :param jenkins_url: the url of jenkins server
+    :param parallel: the number of builds fetched concurrently
+    :param session: the HttpClient used to query jenkins,
+                    one whose pool fits all the concurrent fetches is created if it's None
     :return: a dictionary which contains key, value: build name= build number of the sub builds
     '''
-    build_data = get_build_data(build_url)
+    if parallel < 1:
+        parallel = 1
+    if session is None:
+        session = HttpClient(pool_size=parallel)
+
     builds = {}
-    if build_data:
-        if 'subBuilds' in build_data:
-            for subBuild in build_data['subBuilds']:
-                sub_job_name = subBuild['jobName'] 
-                sub_build_number = subBuild['buildNumber']
-                sub_build_url = jenkins_url + "/" + subBuild['url']
-                builds[sub_job_name] = sub_build_number
-                sub_builds = get_sub_builds(sub_build_url, jenkins_url)
-                builds.update(sub_builds)
+    visited = set([build_url.rstrip("/")])
+    frontier = [build_url]
+    pool = ThreadPool(parallel)
+    try:
+        while frontier:
+            results = pool.map(lambda url: get_build_data(url, session), frontier)
+            frontier = []
+            for build_data in results:
+                if not build_data or 'subBuilds' not in build_data:
+                    continue
+                for subBuild in build_data['subBuilds']:
+                    sub_job_name = subBuild['jobName']
+                    sub_build_number = subBuild['buildNumber']
+                    sub_build_url = jenkins_url + "/" + subBuild['url']
+                    builds[sub_job_name] = sub_build_number
+                    if sub_build_url.rstrip("/") not in visited:
+                        visited.add(sub_build_url.rstrip("/"))
+                        frontier.append(sub_build_url)
+    finally:
+        pool.close()
+        pool.join()
 
     return builds
 
@@ -100,7 +139,7 @@ def is_error_response(res):
 def main():
     args = parse_args(sys.argv[1:])
     try:
-        sub_builds = get_sub_builds(args.build_url, args.jenkins_url)
+        sub_builds = get_sub_builds(args.build_url, args.jenkins_url, args.parallel)
         
         # Replace the special character of job name with _
         # Because these parameters are going to used as linux environment variables 
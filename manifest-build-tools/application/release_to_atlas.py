@@ -30,11 +30,11 @@ The optional parameters:
 
 import sys
 import argparse
-import requests
 import subprocess
 
 try:
     import common
+    from httpclient import HttpClient
 except ImportError as import_err:
     print import_err
     sys.exit(1)
@@ -54,7 +54,7 @@ class Atlas(object):
 
         self.atlas_token = atlas_token
 
-        self.session = requests.Session()
+        self.session = HttpClient()
         self.session.headers.update({'X-Atlas-Token': self.atlas_token})
 
     def upload_handler(self, atlas_version, provider, box_file):
@@ -14,8 +14,19 @@ usage:
     --property_file workspace/property_file
     --credential CREDS
 
+    Or monitor several repos from one long-running process:
+    ./on-tools/manifest-build-tools/HWIMO-BUILD.py \
+    on-tools/manifest-build-tools/application/tag_change_monitor.py \
+    --repo rackhd/on-http \
+    --repo rackhd/on-core \
+    --history_store workspace/tag_history.json \
+    --property_dir workspace/tag_changes \
+    --daemon \
+    --credential CREDS
+
 The required parameters:
     repo: user_name/repo_name that indicates which repo should be monitoring.
+          It can be given several times together with --history_store.
     history_file: A file stored one history tag in each line. If doesn't exists it will be created.
     property_file: A file used for downstream job. It's format is like this:
                   tag_name=release/1.2.3
@@ -27,19 +38,34 @@ The required parameters:
 The optional parameters:
     credential, A env var name which stores user:password of github.
     If you run this scipt continually this parameter is needed, otherwise github will forbidden the api requests.
+    history_store: A json file stored the tag history and the ETags of all the monitored repos.
+                   It replaces history_file when several repos are monitored.
+    property_dir: A directory where one property file is written for each detected tag change,
+                  named as <user_name>_<repo_name>_<commit>.properties. Used with history_store.
+    daemon: Keep running and poll the repos on an adaptive schedule.
+    min_interval: The shortest poll interval of a repo in seconds, default: 60
+    max_interval: The longest poll interval of a repo in seconds, default: 3600
 """
 
 import os
 import sys
+import json
+import time
 import argparse
-import requests
+
+try:
+    import requests
+    from httpclient import HttpClient
+except ImportError as import_err:
+    print import_err
+    sys.exit(1)
 
 class TagChangeMonitor(object):
     """
     A simple class that monitor repo tag updates.
-    One monitor for one repo.
+    One monitor for one repo, use TagMonitorDaemon to monitor several repos.
     """
-    def __init__(self, repo, history_file, property_file, credential):
+    def __init__(self, repo, history_file, property_file, credential, session=None):
         self.api_url = "https://api.github.com"
         self.repo = repo
         self.history_file = history_file
@@ -49,11 +75,19 @@ class TagChangeMonitor(object):
             self.auth = (user, password)
         else:
             self.auth = ()
+        self.session = session or HttpClient()
 
         self.history = {}
         self.new_history = {}
         self.change = {}
+        # url -> [etag, next url] of each tag page got last time
+        self.pages = {}
+        self.fetched_pages = {}
+        # More than one new tag found, only the first is reported in one run
+        self.pending = False
 
+        if history_file is None:
+            return
         if os.path.isfile(history_file):
             with file(history_file, 'r') as f:
                 for tag_commit in f.readlines():
@@ -69,26 +103,75 @@ class TagChangeMonitor(object):
         """
         Do tag monitor job
         """
-        tag_list = self.get_tags()
+        tag_list = self.get_tags(conditional=False)
         self.parse_tag_info(tag_list)
         if self.change:
             self.write_property_file()
         self.write_history_file()
 
-    def get_tags(self):
+    def check_tag_change(self):
         """
-        Get all tags of current repo.
+        Poll the tags of current repo and detect tag change.
+        Nothing is parsed if github reports that no tag page is modified.
+        :return: True if any tag change is found, otherwise False
         """
-        list_tag_url = "/".join([self.api_url, "repos", self.repo, "tags"])
-        if self.auth:
-            resp = requests.get(list_tag_url, auth=self.auth)
-        else:
-            resp = requests.get(list_tag_url)
-        if resp.ok:
-            return resp.json()
+        self.new_history = {}
+        self.change = {}
+        self.pending = False
+        tag_list = self.get_tags()
+        if tag_list is None:
+            return False
+        self.parse_tag_info(tag_list)
+        self.history = self.new_history
+        # Keep polling unconditionally until all the new tags are reported
+        if self.pending:
+            self.pages = {}
         else:
-            print "Get tags of repo {0} error.\n{1}".format(self.repo, resp.text)
-            sys.exit(1)
+            self.pages = self.fetched_pages
+        return bool(self.change)
+
+    def get_tags(self, conditional=True):
+        """
+        Get all tags of current repo, following the Link pagination of github.
+        :param conditional: request every page with the ETag got last time.
+                            Not modified pages don't count against the rate limit.
+        :return: the tag list, or None if no tag page is modified
+        :raise RuntimeError: if github answers an error
+        """
+        list_tag_url = "/".join([self.api_url, "repos", self.repo, "tags"]) + "?per_page=100"
+        tag_list = []
+        self.fetched_pages = {}
+        modified = False
+        not_modified = False
+        url = list_tag_url
+        while url:
+            headers = {}
+            if conditional and url in self.pages:
+                headers['If-None-Match'] = self.pages[url][0]
+            if self.auth:
+                resp = self.session.get(url, auth=self.auth, headers=headers)
+            else:
+                resp = self.session.get(url, headers=headers)
+            if resp.status_code == 304:
+                not_modified = True
+                self.fetched_pages[url] = self.pages[url]
+                url = self.pages[url][1]
+            elif resp.ok:
+                modified = True
+                tag_list.extend(resp.json())
+                next_url = resp.links.get('next', {}).get('url')
+                self.fetched_pages[url] = [resp.headers.get('ETag'), next_url]
+                url = next_url
+            else:
+                raise RuntimeError("Get tags of repo {0} error.\n{1}".format(self.repo, resp.text))
+
+        if not modified:
+            return None
+        if not_modified:
+            # The content of the not modified pages isn't kept,
+            # so get all the pages again once any of them changes.
+            return self.get_tags(conditional=False)
+        return tag_list
 
     def parse_tag_info(self, tag_list):
         """
@@ -107,6 +190,7 @@ class TagChangeMonitor(object):
                     find_change = True
                 else:
                     contains_in_new = False
+                    self.pending = True
 
             if contains_in_new:
                 if self.new_history.has_key(commit):
@@ -141,6 +225,113 @@ class TagChangeMonitor(object):
                 property_file_handler.write(output)
 
 
+class TagHistoryStore(object):
+    """
+    One json file stores the tag history and the tag page ETags of all the monitored repos:
+    {"<user_name>/<repo_name>": {"history": {commit: [tags]}, "pages": {url: [etag, next_url]}}}
+    """
+    def __init__(self, store_file):
+        self.store_file = store_file
+        self.repos = {}
+        if os.path.isfile(store_file):
+            with open(store_file, 'r') as store_handler:
+                self.repos = json.load(store_handler)
+
+    def load(self, monitor):
+        """
+        Restore the history and ETags of a monitor
+        """
+        record = self.repos.get(monitor.repo, {})
+        monitor.history = record.get('history', {})
+        monitor.pages = record.get('pages', {})
+
+    def save(self, monitor):
+        """
+        Record the history and ETags of a monitor, and write the store file.
+        The file is replaced atomically so a killed daemon never leaves a broken store.
+        """
+        self.repos[monitor.repo] = {'history': monitor.history, 'pages': monitor.pages}
+        tmp_file = self.store_file + ".tmp"
+        with open(tmp_file, 'w') as store_handler:
+            json.dump(self.repos, store_handler, separators=(',', ':'), sort_keys=True)
+        os.rename(tmp_file, self.store_file)
+
+
+class TagMonitorDaemon(object):
+    """
+    Monitor tag updates of several repos from one process.
+    Each repo is polled on its own adaptive schedule: the interval is reset to min_interval
+    when a tag change is found and doubled, up to max_interval, when nothing changes.
+    A repo failing to be polled (github error, connection error) is backed off the same
+    way, the other repos keep being polled.
+    """
+    def __init__(self, repos, store_file, property_dir, credential, min_interval=60, max_interval=3600):
+        self.store = TagHistoryStore(store_file)
+        self.property_dir = property_dir
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        session = HttpClient()
+
+        self.monitors = {}
+        self.intervals = {}
+        self.next_poll = {}
+        now = time.time()
+        for repo in repos:
+            monitor = TagChangeMonitor(repo, None, None, credential, session=session)
+            self.store.load(monitor)
+            self.monitors[repo] = monitor
+            self.intervals[repo] = min_interval
+            self.next_poll[repo] = now
+
+        if not os.path.isdir(property_dir):
+            os.makedirs(property_dir)
+
+    def poll(self, repo):
+        """
+        Poll one repo, write a property file for the tag change and reschedule the repo
+        :return: True if the repo is polled, False if polling it failed
+        """
+        monitor = self.monitors[repo]
+        try:
+            changed = monitor.check_tag_change()
+        except (RuntimeError, ValueError, requests.RequestException) as error:
+            print "Failed to poll repo {0}: {1}".format(repo, error)
+            self.intervals[repo] = min(self.intervals[repo] * 2, self.max_interval)
+            self.next_poll[repo] = time.time() + self.intervals[repo]
+            return False
+        if changed:
+            for commit in monitor.change:
+                monitor.property_file = os.path.join(self.property_dir,
+                    "{0}_{1}.properties".format(repo.replace('/', '_'), commit))
+                monitor.write_property_file()
+                print "Found new tag {0} of repo {1}".format(monitor.change[commit][0], repo)
+        if monitor.change or monitor.pending:
+            self.intervals[repo] = self.min_interval
+        else:
+            self.intervals[repo] = min(self.intervals[repo] * 2, self.max_interval)
+        self.store.save(monitor)
+        self.next_poll[repo] = time.time() + self.intervals[repo]
+        return True
+
+    def run_once(self):
+        """
+        Poll all the repos once
+        :return: the repos failing to be polled
+        """
+        return [repo for repo in self.monitors if not self.poll(repo)]
+
+    def run(self):
+        """
+        Poll the repos forever, always the repo whose poll is due first
+        """
+        while True:
+            repo = min(self.next_poll, key=self.next_poll.get)
+            delay = self.next_poll[repo] - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.poll(repo)
+
+
 def parse_args(args):
     """
     Parse script arguments.
@@ -150,24 +341,56 @@ def parse_args(args):
 
     parser.add_argument('--repo',
                         required=True,
-                        help="Indicates the repo",
-                        action='store')
+                        help="Indicates the repo, can be given several times with --history_store",
+                        action='append')
 
     parser.add_argument('--history_file',
-                        required=True,
                         help="File stored tag history",
                         action='store')
 
     parser.add_argument('--property_file',
-                        required=True,
                         help="Downstream file to use",
                         action='store')
 
+    parser.add_argument('--history_store',
+                        help="Json file stored tag history and ETags of all the repos",
+                        action='store')
+
+    parser.add_argument('--property_dir',
+                        help="Directory where a downstream file is written for each tag change",
+                        action='store')
+
+    parser.add_argument('--daemon',
+                        help="Keep polling the repos on an adaptive schedule",
+                        action='store_true')
+
+    parser.add_argument('--min_interval',
+                        help="The shortest poll interval of a repo in seconds",
+                        type=int,
+                        default=60,
+                        action='store')
+
+    parser.add_argument('--max_interval',
+                        help="The longest poll interval of a repo in seconds",
+                        type=int,
+                        default=3600,
+                        action='store')
+
     parser.add_argument('--credential',
                         help="github credits",
                         action='store')
 
     parsed_args = parser.parse_args(args)
+    if parsed_args.daemon and not parsed_args.history_store:
+        parser.error("--history_store is required with --daemon")
+    if parsed_args.history_store:
+        if not parsed_args.property_dir:
+            parser.error("--property_dir is required with --history_store")
+    else:
+        if len(parsed_args.repo) != 1:
+            parser.error("--history_store is required to monitor several repos")
+        if not parsed_args.history_file or not parsed_args.property_file:
+            parser.error("--history_file and --property_file are required")
     return parsed_args
 
 
@@ -177,8 +400,16 @@ def main():
     """
     try:
         args = parse_args(sys.argv[1:])
-        tcm = TagChangeMonitor(args.repo, args.history_file, args.property_file, args.credential)
-        tcm.handle_tag_monitor()
+        if args.history_store:
+            daemon = TagMonitorDaemon(args.repo, args.history_store, args.property_dir, args.credential,
+                                      args.min_interval, args.max_interval)
+            if args.daemon:
+                daemon.run()
+            elif daemon.run_once():
+                sys.exit(1)
+        else:
+            tcm = TagChangeMonitor(args.repo[0], args.history_file, args.property_file, args.credential)
+            tcm.handle_tag_monitor()
     except Exception, e:
         print e
         sys.exit(1)
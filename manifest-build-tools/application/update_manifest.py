@@ -24,6 +24,7 @@ updated_manifest: The property file that leads downstream job.
 
 The optional parameters:
 dryrun: Do not commit any changes, just print what would be done
+manifest_cache: The directory to cache downloaded manifest files by their ETag/Last-Modified
 """
 
 import argparse
@@ -35,10 +36,10 @@ import subprocess
 import sys
 import tempfile
 import shutil
-import requests
 
 #pylint: disable=relative-import
 import config
+from httpclient import HttpClient
 from RepositoryOperator import RepoOperator
 from manifest import Manifest
 
@@ -57,6 +58,7 @@ class UpdateManifest(object):
         __git_credentials - url, credentials pair for the access to github repos
         quiet - used for testing to minimize text written to a terminal
         repo_operator - Class instance of RepoOperator
+        http_client - Class instance of HttpClient shared by all the downloads
         :return: None
         """
         self.__repo = None
@@ -71,6 +73,7 @@ class UpdateManifest(object):
         self.__dryrun = False
         self.quiet = False
         self.repo_operator = RepoOperator()
+        self.http_client = HttpClient()
 
     #pylint: disable=no-self-use
     def parse_args(self, args):
@@ -92,6 +95,9 @@ class UpdateManifest(object):
         parser.add_argument("--manifest_download_url",
                             help="The manifest derectory URL in bintray.",
                             action="store")
+        parser.add_argument("--manifest-cache",
+                            help="OPTIONAL: The directory to cache downloaded manifest files, an unchanged manifest isn't downloaded again",
+                            action="store")
         parser.add_argument("--commit",
                             help="OPTIONAL: The commit id to target an exact version",
                             action="store")
@@ -139,6 +145,9 @@ class UpdateManifest(object):
         else:
             print "\n Must specify a manifest base url for download <manifest>.json files\n"
 
+        if args.manifest_cache:
+            self.http_client = HttpClient(cache_dir=args.manifest_cache)
+
         if args.dryrun:
             self.__dryrun = True
             self.repo_operator.setup_git_dryrun(self.__dryrun)
@@ -182,7 +191,9 @@ class UpdateManifest(object):
     def download_manifest_file(self):
         """
         Download the manifest json files. Return that directory name which stores manifest. The directory
-        is temporary and deleted in the cleanup_and_exit function
+        is temporary and deleted in the cleanup_and_exit function.
+        The manifest is streamed to disk and its size verified, it's copied from the cache
+        instead when --manifest-cache is given and the remote one is not modified.
         :return: A string containing the name of the folder where the manifest file was download.
         """
         directory_name = tempfile.mkdtemp()
@@ -198,16 +209,16 @@ class UpdateManifest(object):
         try:
             url = "/".join([self.__manifest_download_url, self.__manifest_file])
             dest_dir = "/".join([directory_name, self.__manifest_file])
-            if os.environ['BINTRAY_USERNAME'] and os.environ['BINTRAY_API_KEY']:
+            auth = None
+            if os.environ.get('BINTRAY_USERNAME') and os.environ.get('BINTRAY_API_KEY'):
                 print "Requests bintray with token"
                 auth = (os.environ['BINTRAY_USERNAME'].strip(), os.environ['BINTRAY_API_KEY'].strip())
-                resp = requests.get(url, auth=auth)
             else:
                 print "Requests without token"
-                resp = requests.get(url)
+            resp = self.http_client.download(url, dest_dir, auth=auth)
             if resp.ok:
-                with open(dest_dir, "wb") as file_handle:
-                    file_handle.write(resp.content)
+                if resp.from_cache:
+                    print "manifest {0} is not modified, use the cached one".format(self.__manifest_file)
             elif resp.status_code==404:
                 # If there's no manifest file in bintray server, init an empty one
                 print "can't find manifest in remote server, will use template manifest"
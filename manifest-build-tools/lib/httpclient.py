@@ -0,0 +1,217 @@
+# Copyright 2016, EMC, Inc.
+
+"""
+Module to share one HTTP client setup between the application scripts.
+
+HttpClient is a requests.Session with:
+  - a connection pool, so the connections are kept alive and reused
+  - a default timeout for every request
+  - retry with exponential backoff on connection errors and 5xx responses
+    (only for idempotent methods, a POST is never sent twice)
+  - gzip transfer, requests asks for and decodes gzip transparently
+  - an optional on-disk cache of GET responses, revalidated with
+    If-None-Match/If-Modified-Since so an unchanged resource is not downloaded again
+  - download of a file streamed to disk with size/checksum verification
+
+usage:
+    from httpclient import HttpClient
+    client = HttpClient(cache_dir="workspace/http_cache")
+    resp = client.get(url, auth=auth)
+    resp = client.download(url, "manifest.json", auth=auth)
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+# (connect timeout, read timeout) in seconds
+DEFAULT_TIMEOUT = (10, 120)
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CHUNK_SIZE = 64 * 1024
+RETRY_STATUS = (500, 502, 503, 504)
+
+class HttpClient(requests.Session):
+    """
+    A pooled requests.Session with timeout, retry and an optional conditional GET cache
+    """
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES,
+                 backoff_factor=DEFAULT_BACKOFF_FACTOR, pool_size=DEFAULT_POOL_SIZE,
+                 cache_dir=None):
+        """
+        :param timeout: the default timeout of a request, a number or a (connect, read) tuple
+        :param retries: the max number of retries of a request
+        :param backoff_factor: sleep backoff_factor * (2 ^ (retry number - 1)) seconds between retries
+        :param pool_size: the max number of connections kept alive for one host
+        :param cache_dir: the directory to cache GET responses, no cache if it's None
+        """
+        super(HttpClient, self).__init__()
+        self.timeout = timeout
+        self.cache_dir = cache_dir
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        retry = Retry(total=retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=RETRY_STATUS,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):
+        """
+        Send a request with the default timeout.
+        GET requests go through the cache when cache_dir is set.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        if self.cache_dir is None or method.upper() != 'GET' or kwargs.get('stream'):
+            return super(HttpClient, self).request(method, url, **kwargs)
+        return self.__cached_get(method, url, **kwargs)
+
+    def __cache_paths(self, url, params):
+        """
+        :return: the paths of the metadata file and the body file cached for the url
+        """
+        key = url
+        if params:
+            key += json.dumps(params, sort_keys=True)
+        name = hashlib.sha1(key).hexdigest()
+        base = os.path.join(self.cache_dir, name)
+        return base + ".json", base + ".body"
+
+    def __load_cache_meta(self, meta_path, body_path, headers):
+        """
+        Load the metadata of a cached response and add the conditional headers for it
+        :return: the metadata, None if the response isn't cached
+        """
+        if not (os.path.isfile(meta_path) and os.path.isfile(body_path)):
+            return None
+        with open(meta_path, 'r') as meta_file:
+            meta = json.load(meta_file)
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return meta
+
+    def __save_cache_meta(self, meta_path, url, resp):
+        """
+        Write the metadata of a response whose body has been cached
+        """
+        meta = {'url': url,
+                'etag': resp.headers.get('ETag'),
+                'last_modified': resp.headers.get('Last-Modified'),
+                'headers': {'Content-Type': resp.headers.get('Content-Type', '')}}
+        with open(meta_path, 'w') as meta_file:
+            json.dump(meta, meta_file)
+
+    def __cached_get(self, method, url, **kwargs):
+        """
+        Revalidate the cached response of url, the response body is read from
+        the cache when the server answers 304 Not Modified.
+        """
+        meta_path, body_path = self.__cache_paths(url, kwargs.get('params'))
+        headers = dict(kwargs.get('headers') or {})
+        meta = self.__load_cache_meta(meta_path, body_path, headers)
+        kwargs['headers'] = headers
+
+        resp = super(HttpClient, self).request(method, url, **kwargs)
+
+        if resp.status_code == 304 and meta is not None:
+            with open(body_path, 'rb') as body_file:
+                resp._content = body_file.read()
+            resp.status_code = 200
+            resp.headers.update(meta['headers'])
+            resp.from_cache = True
+            return resp
+
+        resp.from_cache = False
+        if resp.status_code == 200 and (resp.headers.get('ETag') or resp.headers.get('Last-Modified')):
+            with open(body_path, 'wb') as body_file:
+                body_file.write(resp.content)
+            self.__save_cache_meta(meta_path, url, resp)
+        return resp
+
+    def download(self, url, dest, sha256=None, chunk_size=DEFAULT_CHUNK_SIZE, **kwargs):
+        """
+        Download url to the file dest.
+        The body is streamed to a temporary file next to dest, which is verified and then
+        renamed to dest, so dest is never left half written. When cache_dir is set, the
+        file is revalidated with its ETag/Last-Modified and copied from the cache if unchanged.
+        :param url: the url of the file
+        :param dest: the path of the downloaded file
+        :param sha256: the expected sha256 hex digest of the file, not checked if it's None
+        :param chunk_size: the size of the chunks written to disk
+        :param kwargs: other arguments of requests, such as auth
+        :return: the response, dest is written only if the response is ok
+                 Raise RuntimeError if the downloaded file fails verification
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        headers = dict(kwargs.pop('headers', None) or {})
+        meta_path = body_path = meta = None
+        if self.cache_dir is not None:
+            meta_path, body_path = self.__cache_paths(url, kwargs.get('params'))
+            meta = self.__load_cache_meta(meta_path, body_path, headers)
+
+        resp = super(HttpClient, self).request('GET', url, headers=headers, stream=True, **kwargs)
+        try:
+            if resp.status_code == 304 and meta is not None:
+                if sha256 is not None:
+                    verify_file(body_path, sha256=sha256)
+                shutil.copyfile(body_path, dest)
+                resp.status_code = 200
+                resp.from_cache = True
+                return resp
+            resp.from_cache = False
+            if not resp.ok:
+                return resp
+
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dest)))
+            try:
+                with os.fdopen(fd, 'wb') as tmp_file:
+                    for chunk in resp.iter_content(chunk_size=chunk_size):
+                        tmp_file.write(chunk)
+                size = None
+                # The length of an encoded body is the length before decoding
+                if 'Content-Length' in resp.headers and 'Content-Encoding' not in resp.headers:
+                    size = int(resp.headers['Content-Length'])
+                verify_file(tmp_path, size=size, sha256=sha256)
+                os.rename(tmp_path, dest)
+            except:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        finally:
+            resp.close()
+
+        if self.cache_dir is not None and (resp.headers.get('ETag') or resp.headers.get('Last-Modified')):
+            shutil.copyfile(dest, body_path)
+            self.__save_cache_meta(meta_path, url, resp)
+        return resp
+
+
+def verify_file(path, size=None, sha256=None):
+    """
+    Verify the size and sha256 checksum of a file
+    :param path: the path of the file
+    :param size: the expected size in bytes, not checked if it's None
+    :param sha256: the expected sha256 hex digest, not checked if it's None
+    :return: None on success
+             Raise RuntimeError if the file doesn't match
+    """
+    if size is not None and os.path.getsize(path) != size:
+        raise RuntimeError("Size of {0} is {1}, expected {2}".format(path, os.path.getsize(path), size))
+    if sha256 is not None:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file_handle:
+            for chunk in iter(lambda: file_handle.read(DEFAULT_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        if digest.hexdigest() != sha256.lower():
+            raise RuntimeError("Checksum of {0} is {1}, expected {2}".format(path, digest.hexdigest(), sha256))
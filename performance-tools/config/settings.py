@@ -10,5 +10,7 @@ LOGLEVELS = {
     'DEBUG': logging.DEBUG
 }
 LOGGER_LVL = "ERROR"
+# Dispatch log records from a background thread (see modules/logger.py)
+LOGGER_ASYNC = False
 logging.basicConfig(level=LOGLEVELS[LOGGER_LVL], format=LOGFORMAT)
 
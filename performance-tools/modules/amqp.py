@@ -7,7 +7,10 @@ from threading import Thread
 from kombu.mixins import ConsumerMixin
 from kombu import BrokerConnection
 from modules.worker import WorkerThread, WorkerTasks
-import signal, sys
+from Queue import Empty
+import multiprocessing
+import socket
+import signal, sys, time
 
 LOG = Log('kombu')
 
@@ -18,6 +21,13 @@ Class to abstract AMQP consumer event handling
 :param queue: The queue exchange to listen on for events
 :param max_retries: Number of connection attempts
 :param max_error: Max number of errored connection recovery attempts
+:param prefetch: optional prefetch count (basic_qos) of the consumer channel
+:param ack_batch: optional number of messages acknowledged at once by the worker,
+                  the callbacks must not ack the messages themselves in that mode.
+                  Pending messages are also acked when the queue is idle.
+:param on_batch: optional function called before each batch acknowledgment
+:param on_iteration: optional function called on each consumer loop iteration
+:param transport_options: optional kombu transport options of the connection
 """
 class AMQPWorker(ConsumerMixin):
     def __init__(self, **kwargs):
@@ -26,16 +36,55 @@ class AMQPWorker(ConsumerMixin):
         self.__queue = kwargs.get('queue')
         self.__max_retries = kwargs.get('max_retries',2)
         self.__max_error = kwargs.get('max_error',3)
+        self.__prefetch = kwargs.get('prefetch')
+        self.__ack_batch = kwargs.get('ack_batch')
+        self.__on_batch = kwargs.get('on_batch')
+        self.__on_iteration = kwargs.get('on_iteration')
+        self.__unacked = []
         if self.__queue is None:
             raise TypeError('invalid worker queue parameter')
-        self.connection = BrokerConnection(self.__amqp_url)
+        self.connection = BrokerConnection(self.__amqp_url,
+                transport_options=kwargs.get('transport_options'))
         self.connection.ensure_connection(max_retries=self.__max_retries,
                 errback=self.on_connection_error, callback=self.on_conn_retry)
 
     def get_consumers(self, consumer, channel):
         if not isinstance(self.__callbacks,list):
             self.__callbacks = [ self.__callbacks ]
-        return [consumer(self.__queue, callbacks=self.__callbacks)]
+        callbacks = list(self.__callbacks)
+        if self.__ack_batch:
+            callbacks.append(self.__batch_ack)
+        c = consumer(self.__queue, callbacks=callbacks)
+        if self.__prefetch:
+            c.qos(prefetch_count=self.__prefetch)
+        return [c]
+
+    def __batch_ack(self, body, message):
+        self.__unacked.append(message)
+        if len(self.__unacked) >= self.__ack_batch:
+            self.flush_acks()
+
+    def flush_acks(self):
+        if not self.__unacked:
+            return
+        if self.__on_batch:
+            self.__on_batch()
+        # ack every message delivered on the channel up to the last one
+        message = self.__unacked[-1]
+        try:
+            message.channel.basic_ack(message.delivery_tag, multiple=True)
+        except TypeError:
+            # virtual transports (memory://) can only ack one message at a time
+            for message in self.__unacked:
+                message.ack()
+        self.__unacked = []
+
+    def on_iteration(self):
+        if self.__on_iteration:
+            self.__on_iteration()
+
+    def on_consume_end(self, connection, channel):
+        self.flush_acks()
 
     def on_message(self, body, message):
         out = {
@@ -55,7 +104,7 @@ class AMQPWorker(ConsumerMixin):
             self.__max_error -= 1
         else:
             LOG.error('max connection errors exceeded.')
-            stop()
+            self.stop()
 
     def start(self):
         LOG.info('Starting AMQP worker {0}'.format(self.__queue))
@@ -66,6 +115,126 @@ class AMQPWorker(ConsumerMixin):
         LOG.info('Stopping AMQP worker {0}'.format(self.__queue))
         self.should_stop = True
 
+"""
+Class to consume AMQP events from several processes
+Each process runs an AMQPWorker with a prefetch window and batched acknowledgments,
+and forwards the (routing_key, time_stamp) of every message to the parent in one
+multiprocessing queue put per batch. start() collects the events in the calling
+thread, like AMQPWorker.start, and invokes the callbacks for each of them.
+:param callbacks: functions called as callback(routing_key, time_stamp) in the parent
+:param queue: The queue exchange to listen on for events
+:param amqp_url: optional AMQP URL to connect, defaults from config/amqp.py
+:param processes: optional number of consumer processes
+:param prefetch: optional prefetch count of each consumer
+:param ack_batch: optional number of messages acknowledged and forwarded at once
+:param flush_interval: optional max seconds a partial batch is held while messages keep coming
+:param transport_options: optional kombu transport options of the consumer connections
+"""
+class AMQPConsumerPool(object):
+    def __init__(self, **kwargs):
+        self.__callbacks = kwargs.get('callbacks',[])
+        self.__amqp_url = kwargs.get('amqp_url',AMQP_URL)
+        self.__queue = kwargs.get('queue')
+        self.__processes = max(1, kwargs.get('processes',4))
+        self.__prefetch = kwargs.get('prefetch',1000)
+        self.__ack_batch = kwargs.get('ack_batch',100)
+        self.__flush_interval = kwargs.get('flush_interval',0.1)
+        self.__transport_options = kwargs.get('transport_options')
+        if self.__queue is None:
+            raise TypeError('invalid worker queue parameter')
+        if not isinstance(self.__callbacks,list):
+            self.__callbacks = [ self.__callbacks ]
+        self.__events = multiprocessing.Queue()
+        self.__stop_event = multiprocessing.Event()
+        self.__workers = []
+
+    def __consume(self):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        buffer = []
+        def on_message(body, message):
+            buffer.append((message.delivery_info.get('routing_key'), time.time()))
+        last_flush = [time.time()]
+        def on_batch():
+            self.__events.put(list(buffer))
+            del buffer[:]
+            last_flush[0] = time.time()
+        def on_iteration():
+            if self.__stop_event.is_set():
+                worker.stop()
+            elif buffer and time.time() - last_flush[0] >= self.__flush_interval:
+                worker.flush_acks()
+        worker = AMQPWorker(queue=self.__queue, amqp_url=self.__amqp_url, callbacks=[on_message],
+                            prefetch=self.__prefetch, ack_batch=self.__ack_batch,
+                            on_batch=on_batch, on_iteration=on_iteration,
+                            transport_options=self.__transport_options)
+        worker.start()
+
+    def __dispatch(self, events):
+        for routing_key, time_stamp in events:
+            for callback in self.__callbacks:
+                callback(routing_key, time_stamp)
+
+    def start(self):
+        LOG.info('Starting {0} AMQP consumers {1}'.format(self.__processes, self.__queue))
+        self.__stop_event.clear()
+        self.__workers = [multiprocessing.Process(target=self.__consume) for n in range(self.__processes)]
+        for worker in self.__workers:
+            worker.daemon = True
+            worker.start()
+        # keep draining until the consumers exit, they flush their last batch when stopping
+        while any(w.is_alive() for w in self.__workers):
+            try:
+                self.__dispatch(self.__events.get(timeout=0.5))
+            except Empty:
+                pass
+        while True:
+            try:
+                self.__dispatch(self.__events.get_nowait())
+            except Empty:
+                break
+        for worker in self.__workers:
+            worker.join()
+        failed = [w.exitcode for w in self.__workers if w.exitcode]
+        if failed:
+            raise RuntimeError('AMQP consumers of {0} failed with exit codes {1}'.format(self.__queue.name, failed))
+        if not self.__stop_event.is_set():
+            raise RuntimeError('AMQP consumers of {0} exited before being stopped'.format(self.__queue.name))
+
+    def stop(self):
+        LOG.info('Stopping AMQP consumers {0}'.format(self.__queue))
+        self.__stop_event.set()
+
+def drain_queue(queue, **kwargs):
+    """
+    Discard every message waiting in a queue so a benchmark starts from an empty queue.
+    The queue is purged; messages a purge can't remove (delivered to other consumers and
+    requeued meanwhile) are then consumed without acknowledgment until the queue stays
+    idle for idle_timeout seconds.
+    :param queue: the queue to drain, declared if it doesn't exist
+    :param amqp_url: optional AMQP URL to connect, defaults from config/amqp.py
+    :param idle_timeout: optional seconds without message after which the queue is drained
+    :param transport_options: optional kombu transport options of the connection
+    :return: the number of messages discarded
+    """
+    amqp_url = kwargs.get('amqp_url',AMQP_URL)
+    idle_timeout = kwargs.get('idle_timeout',0.5)
+    discarded = [0]
+    def on_message(body, message):
+        discarded[0] += 1
+    with BrokerConnection(amqp_url, transport_options=kwargs.get('transport_options')) as conn:
+        bound = queue(conn.default_channel)
+        bound.declare()
+        discarded[0] += bound.purge() or 0
+        if bound.queue_declare(passive=True).message_count:
+            with conn.Consumer(bound, callbacks=[on_message], no_ack=True):
+                while True:
+                    try:
+                        conn.drain_events(timeout=idle_timeout)
+                    except socket.timeout:
+                        break
+    LOG.info('Drained {0} messages from {1}'.format(discarded[0], queue.name))
+    return discarded[0]
+
 def run_listener(q,timeout_sec=3):
     log = Log(__name__,level='INFO')
     log.info('Run AMQP listener until ctrl-c input\n {0}'.format(q))
@@ -0,0 +1,156 @@
+from logger import Log
+from config.amqp import EXCHANGE_EVENT
+from threading import Thread, Lock
+from Queue import Queue
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from kombu import Connection, Producer
+from json import dumps
+import random
+import time
+import uuid
+import re
+
+LOG = Log(__name__)
+
+WORKFLOW_PATH = re.compile(r'^/api/(1\.1|2\.0)(/nodes/[^/]+)?/workflows/?(\?.*)?$')
+NODES_PATH = re.compile(r'^/api/(1\.1|2\.0)/nodes/?(\?.*)?$')
+
+def service_time_sampler(spec):
+    """
+    Build a function returning service times in seconds from a distribution spec:
+    const:<t>, exp:<mean>, uniform:<min>,<max> or lognormal:<mu>,<sigma>
+    """
+    kind, _, values = spec.partition(':')
+    args = [float(v) for v in values.split(',') if v]
+    if kind == 'const':
+        return lambda: args[0]
+    if kind == 'exp':
+        return lambda: random.expovariate(1.0 / args[0]) if args[0] > 0 else 0.0
+    if kind == 'uniform':
+        return lambda: random.uniform(args[0], args[1])
+    if kind == 'lognormal':
+        return lambda: random.lognormvariate(args[0], args[1])
+    raise ValueError('unknown service time distribution {0}'.format(spec))
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+"""
+Class to stand in for RackHD when benchmarking the performance tooling offline
+It accepts workflow posts (POST /api/1.1/workflows, /api/2.0/workflows and
+/api/2.0/nodes/<id>/workflows) and answers GET /api/<version>/nodes. Each accepted
+workflow is queued to `workers` graph runners, which spend a service time drawn from
+the distribution and publish graph.finished.<id> on the on.events exchange, so
+throughput saturates like a server of that capacity. `failure_rate` of the posts
+are answered 500. With the default memory:// transport the events only reach
+consumers of the same process.
+:param host: optional listening address, default 127.0.0.1
+:param port: optional listening port, default any free port
+:param amqp_url: optional AMQP URL to publish events, default memory://
+:param service_time: optional service time distribution, see service_time_sampler
+:param failure_rate: optional fraction of posts failing, default 0
+:param workers: optional number of graphs run concurrently, default 4
+"""
+class FakeRackHD(object):
+    def __init__(self, **kwargs):
+        self.__host = kwargs.get('host','127.0.0.1')
+        self.__port = kwargs.get('port',0)
+        self.__amqp_url = kwargs.get('amqp_url','memory://')
+        self.__service_time = service_time_sampler(kwargs.get('service_time','exp:0.01'))
+        self.__failure_rate = kwargs.get('failure_rate',0.0)
+        self.__workers = max(1, kwargs.get('workers',4))
+        self.__graphs = Queue()
+        self.__publish_lock = Lock()
+        self.__count_lock = Lock()
+        self.__server = None
+        self.__threads = []
+        self.__connection = None
+        self.__producer = None
+        self.posted = 0
+        self.failed = 0
+        self.finished = 0
+
+    @property
+    def address(self):
+        host, port = self.__server.server_address
+        return '{0}:{1}'.format(host, port)
+
+    def __handler(self):
+        fake = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def __reply(self, status, body):
+                data = dumps(body)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+                if not WORKFLOW_PATH.match(self.path):
+                    return self.__reply(404, {'message': 'Not Found'})
+                status, body = fake.post_workflow()
+                self.__reply(status, body)
+
+            def do_GET(self):
+                if not NODES_PATH.match(self.path):
+                    return self.__reply(404, {'message': 'Not Found'})
+                self.__reply(200, [])
+
+            def log_message(self, *args):
+                pass
+        return Handler
+
+    def post_workflow(self):
+        # called from the request threads of the HTTP server
+        if self.__failure_rate and random.random() < self.__failure_rate:
+            with self.__count_lock:
+                self.failed += 1
+            return 500, {'message': 'Internal Server Error'}
+        graph_id = str(uuid.uuid4())
+        with self.__count_lock:
+            self.posted += 1
+        self.__graphs.put(graph_id)
+        return 201, {'instanceId': graph_id, 'name': 'Graph.noop-example', '_status': 'valid'}
+
+    def __run_graphs(self):
+        while True:
+            graph_id = self.__graphs.get()
+            if graph_id is None:
+                break
+            time.sleep(self.__service_time())
+            self.__publish(graph_id)
+
+    def __publish(self, graph_id):
+        with self.__publish_lock:
+            self.__producer.publish({'graphId': graph_id, 'status': 'succeeded'},
+                                    routing_key='graph.finished.{0}'.format(graph_id))
+            self.finished += 1
+
+    def start(self):
+        self.__connection = Connection(self.__amqp_url)
+        self.__producer = Producer(self.__connection.channel(), exchange=EXCHANGE_EVENT)
+        self.__producer.declare()
+        self.__server = ThreadingHTTPServer((self.__host, self.__port), self.__handler())
+        self.__threads = [Thread(target=self.__run_graphs) for n in range(self.__workers)]
+        self.__threads.append(Thread(target=self.__server.serve_forever))
+        for thread in self.__threads:
+            thread.daemon = True
+            thread.start()
+        LOG.info('Fake RackHD listening on {0}, events on {1}'.format(self.address, self.__amqp_url))
+
+    def stop(self):
+        LOG.info('Stopping fake RackHD {0}'.format(self.address))
+        self.__server.shutdown()
+        self.__server.server_close()
+        for n in range(self.__workers):
+            self.__graphs.put(None)
+        for thread in self.__threads:
+            thread.join()
+        self.__connection.release()
@@ -0,0 +1,158 @@
+from logger import Log
+from threading import Thread, Event, Lock
+from Queue import Queue
+from requests.adapters import HTTPAdapter
+import requests
+import math
+import time
+
+LOG = Log(__name__)
+
+"""
+Class to generate HTTP load against RackHD
+Closed-loop (rate=None): `concurrency` senders each keep one request in flight,
+the time stamp of a request is the time it is sent.
+Open-loop (rate=N): requests are scheduled at N per second whatever the response
+time, `concurrency` senders issue them. The time stamp of a request is the time it
+was scheduled, not the time a sender got to it, so the latency measured from it
+includes the queueing delay of a saturated server (no coordinated omission).
+In both modes the load ramps up linearly over `ramp_up` seconds, and stops after
+`total` requests or `duration` seconds, whichever comes first.
+:param url: the request url, or a list of urls used in turn
+:param callback: called as callback(response, time_stamp, index) after each request,
+                 response is None on connection error
+:param method: optional HTTP method, default POST
+:param data: optional request body
+:param headers: optional request headers
+:param total: optional total number of requests
+:param duration: optional duration of the load in seconds
+:param concurrency: number of concurrent senders, size of the connection pool
+:param rate: optional target rate in requests/sec, enables open-loop mode
+:param ramp_up: optional ramp-up period in seconds
+:param timeout: optional request timeout in seconds
+"""
+class LoadGenerator(object):
+    def __init__(self, url, callback, **kwargs):
+        self.__urls = url if isinstance(url, list) else [url]
+        self.__callback = callback
+        self.__method = kwargs.get('method','POST')
+        self.__data = kwargs.get('data')
+        self.__headers = kwargs.get('headers')
+        self.__total = kwargs.get('total')
+        self.__duration = kwargs.get('duration')
+        if self.__total is None and self.__duration is None:
+            raise TypeError('expected total or duration of the load')
+        self.__concurrency = max(1, kwargs.get('concurrency',1))
+        self.__rate = kwargs.get('rate')
+        self.__ramp_up = max(0.0, float(kwargs.get('ramp_up',0)))
+        self.__timeout = kwargs.get('timeout',30)
+        self.__stopped = Event()
+        self.__lock = Lock()
+        self.__claimed = 0
+        self.__end = None
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.__concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def start(self):
+        LOG.info('Starting load generator {0} {1}'.format(self.__method, self.__urls[0]))
+        self.__stopped.clear()
+        self.__end = None
+        if self.__duration is not None:
+            self.__end = time.time() + self.__duration
+        if self.__rate:
+            self.__open_loop()
+        else:
+            self.__closed_loop()
+
+    def stop(self):
+        LOG.info('Stopping load generator {0} {1}'.format(self.__method, self.__urls[0]))
+        self.__stopped.set()
+
+    def close(self):
+        self.session.close()
+
+    def schedule(self, index):
+        """
+        Offset in seconds from the start at which the index-th request is due in open-loop
+        mode. The rate grows linearly from 0 during ramp-up, so the first rate*ramp_up/2
+        requests are sent during the ramp-up.
+        """
+        ramp_count = self.__rate * self.__ramp_up / 2.0
+        if index < ramp_count:
+            return math.sqrt(2.0 * self.__ramp_up * index / self.__rate)
+        return self.__ramp_up + (index - ramp_count) / self.__rate
+
+    def __more(self, index):
+        if self.__total is not None and index >= self.__total:
+            return False
+        if self.__end is not None and time.time() >= self.__end:
+            return False
+        return not self.__stopped.is_set()
+
+    def __send(self, index, time_stamp):
+        url = self.__urls[index % len(self.__urls)]
+        try:
+            resp = self.session.request(self.__method, url, data=self.__data,
+                                        headers=self.__headers, timeout=self.__timeout)
+        except requests.RequestException as e:
+            LOG.error('request {0} {1} failed: {2}'.format(self.__method, url, e))
+            resp = None
+        self.__callback(resp, time_stamp, index)
+
+    def __run_threads(self, target, args_list):
+        threads = [Thread(target=target, args=args) for args in args_list]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        return threads
+
+    def __open_loop(self):
+        queue = Queue()
+        def sender():
+            while True:
+                item = queue.get()
+                if item is None:
+                    break
+                self.__send(*item)
+        threads = self.__run_threads(sender, [()] * self.__concurrency)
+        start = time.time()
+        index = 0
+        while True:
+            due = start + self.schedule(index)
+            if self.__end is not None and due >= self.__end:
+                break
+            delay = due - time.time()
+            if delay > 0 and self.__stopped.wait(delay):
+                break
+            if not self.__more(index):
+                break
+            queue.put((index, due))
+            index += 1
+        for thread in threads:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def __claim(self):
+        with self.__lock:
+            if not self.__more(self.__claimed):
+                return None
+            self.__claimed += 1
+            return self.__claimed - 1
+
+    def __closed_loop(self):
+        self.__claimed = 0
+        step = self.__ramp_up / self.__concurrency
+        def sender(delay):
+            if delay > 0 and self.__stopped.wait(delay):
+                return
+            while True:
+                index = self.__claim()
+                if index is None:
+                    break
+                self.__send(index, time.time())
+        threads = self.__run_threads(sender, [(n * step,) for n in range(self.__concurrency)])
+        for thread in threads:
+            thread.join()
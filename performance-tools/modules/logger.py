@@ -1,8 +1,68 @@
-
 from config.settings import *
+from threading import Thread
+from Queue import Queue
 import logging
+import atexit
 from json import dumps,loads
 
+"""
+Message rendering an object as compact JSON only when a handler formats it
+"""
+class JsonMessage(object):
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return dumps(self.obj,sort_keys=True,separators=(',',':'),default=str)
+
+"""
+Handler queueing log records to a background thread which passes them to the
+handlers it replaced, so logging never blocks the calling thread on formatting or I/O
+:param handlers: the handlers records are dispatched to
+"""
+class AsyncHandler(logging.Handler):
+    def __init__(self, handlers):
+        logging.Handler.__init__(self)
+        self.__handlers = handlers
+        self.__queue = Queue()
+        self.__thread = Thread(target=self.__dispatch)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def emit(self, record):
+        self.__queue.put(record)
+
+    def __dispatch(self):
+        while True:
+            record = self.__queue.get()
+            if record is None:
+                break
+            for handler in self.__handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def close(self):
+        if self.__thread.is_alive():
+            self.__queue.put(None)
+            self.__thread.join()
+        logging.Handler.close(self)
+
+def enable_async_logging():
+    """
+    Move the root logger handlers behind an AsyncHandler
+    """
+    root = logging.getLogger()
+    if any(isinstance(h, AsyncHandler) for h in root.handlers):
+        return
+    handler = AsyncHandler(list(root.handlers))
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(handler)
+    atexit.register(handler.close)
+
+if LOGGER_ASYNC:
+    enable_async_logging()
+
 """
 Class to abstract python logging functionality
 :param name: optional logging name
@@ -16,24 +76,23 @@ class Log(object):
         self._logger.setLevel(LOGLEVELS[self._level])
 
     def critical(self,m,json=False):
-        self.__log('critical',m,json)
+        self.__log(logging.CRITICAL,m,json)
 
     def info(self,m,json=False):
-        self.__log('info',m,json)
+        self.__log(logging.INFO,m,json)
 
     def debug(self,m,json=False):
-        self.__log('debug',m,json)
+        self.__log(logging.DEBUG,m,json)
 
     def error(self,m,json=False):
-        self.__log('error',m,json)
+        self.__log(logging.ERROR,m,json)
 
     def warning(self,m,json=False):
-        self.__log('warning',m,json)
+        self.__log(logging.WARNING,m,json)
 
-    def __log(self,attr,m,json=False):
+    def __log(self,level,m,json=False):
+        if not self._logger.isEnabledFor(level):
+            return
         if json:
-            m = dumps(m,sort_keys=True,indent=4,separators=(',', ': ')) \
-                    .decode('string-escape')
-        return getattr(self._logger,attr)(m)
-
-
+            m = JsonMessage(m)
+        return self._logger.log(level,m)
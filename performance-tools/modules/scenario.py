@@ -0,0 +1,291 @@
+from logger import Log
+from amqp import AMQPWorker, AMQPConsumerPool, drain_queue
+from loadgen import LoadGenerator
+from tracker import WorkflowTracker
+from worker import PeriodicTask
+from config import amqp as amqp_config
+from threading import Thread, Event
+from urllib import urlencode
+import json
+import time
+import sys
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+LOG = Log(__name__)
+
+"""
+A scenario declares the requests issued against RackHD and, optionally, the AMQP
+event that tells each of them is complete, e.g.:
+{
+    "name": "noop",
+    "api": "1.1",
+    "request": {
+        "method": "POST",
+        "path": "/workflows",
+        "params": {"name": "Graph.noop-example"},
+        "body": null,
+        "nodes": [],
+        "expect_status": [201],
+        "id_field": "instanceId"
+    },
+    "completion": {
+        "queue": "QUEUE_GRAPH_FINISH",
+        "id_prefix": "graph.finished."
+    },
+    "load": {"total": 20, "duration": null, "concurrency": 1, "rate": null, "ramp_up": 0},
+    "consumers": {"processes": 0, "prefetch": 1000, "ack_batch": 100}
+}
+request.path may contain {node}, it is then issued against request.nodes in turn.
+A node id written as a <placeholder> must be replaced (see performance.py --nodes).
+request.id_field is the field of the JSON response identifying the job (graph id).
+completion.queue names a queue of config/amqp.py, or completion gives the
+exchange, queue and routing_key of a topic queue to bind. The id of a completed
+job is its routing key without id_prefix (default: the last dotted part).
+Without completion, a request is complete when its response is received.
+The load stops after load.total requests or load.duration seconds.
+"""
+DEFAULT_SCENARIO = {
+    'name': 'noop',
+    'api': '1.1',
+    'request': {
+        'method': 'POST',
+        'path': '/workflows',
+        'params': {'name': 'Graph.noop-example'},
+        'expect_status': [201],
+        'id_field': 'instanceId'
+    },
+    'completion': {
+        'queue': 'QUEUE_GRAPH_FINISH',
+        'id_prefix': 'graph.finished.'
+    },
+    'load': {'total': 20}
+}
+
+def load_scenario(path):
+    with open(path) as f:
+        if path.endswith('.yaml') or path.endswith('.yml'):
+            if yaml is None:
+                raise ImportError('PyYAML is required to load {0}'.format(path))
+            return yaml.safe_load(f)
+        return json.load(f)
+
+def completion_queue(completion):
+    if 'exchange' in completion:
+        return amqp_config.make_queue_obj(completion['exchange'], completion['queue'],
+                                          completion['routing_key'])
+    queue = getattr(amqp_config, completion['queue'], None)
+    if queue is None:
+        raise ValueError('unknown queue {0} in config/amqp.py'.format(completion['queue']))
+    return queue
+
+"""
+Class to run a scenario and report its throughput and latency
+:param scenario: the scenario dict
+:param host: RackHD IP:PORT
+:param refresh_rate: optional refresh rate of the screen (per sec)
+:param sampling_window: optional period over which the throughput is calculated
+:param amqp_url: optional AMQP URL to connect, defaults from config/amqp.py
+:param transport_options: optional kombu transport options of the AMQP connections
+"""
+class ScenarioRunner(object):
+    def __init__(self, scenario, host, **kwargs):
+        self.scenario = scenario
+        self.__host = host
+        self.__refresh_rate = kwargs.get('refresh_rate',15)
+        self.__sampling_window = kwargs.get('sampling_window',3.0)
+        self.__amqp_url = kwargs.get('amqp_url') or amqp_config.AMQP_URL
+        self.__transport_options = kwargs.get('transport_options')
+        self.__request = scenario['request']
+        self.__completion = scenario.get('completion')
+        self.__expect_status = self.__request.get('expect_status')
+        self.__id_field = self.__request.get('id_field')
+        if self.__completion and not self.__id_field:
+            raise ValueError('request.id_field is required to correlate completion events')
+        placeholders = [node for node in self.__request.get('nodes') or [] if node.startswith('<') and node.endswith('>')]
+        if placeholders:
+            raise ValueError('request.nodes of scenario {0} contains the placeholder {1}, give the node ids '
+                             'in the scenario file or with --nodes'.format(scenario.get('name'), ', '.join(placeholders)))
+        self.done = Event()
+        self.workflows = WorkflowTracker()
+        self.throughput = 0.0
+        self.agrigate_throughput = 0.0
+        self.start_time = 0
+        self.end_time = 0
+        self.__last_sample = (0, 0)
+        self.__listener = None
+        self.__load_generator = self.__make_load_generator()
+
+    def __urls(self):
+        base_url = 'http://{0}/api/{1}'.format(self.__host, self.scenario.get('api','1.1'))
+        path = self.__request['path']
+        query = ''
+        if self.__request.get('params'):
+            query = '?' + urlencode(self.__request['params'])
+        nodes = self.__request.get('nodes')
+        if nodes:
+            return [base_url + path.format(node=node) + query for node in nodes]
+        return base_url + path + query
+
+    def __make_load_generator(self):
+        load = self.scenario.get('load', {})
+        data = self.__request.get('body')
+        headers = None
+        if data is not None:
+            data = json.dumps(data)
+            headers = {'Content-Type': 'application/json'}
+        return LoadGenerator(self.__urls(), self.__handle_response,
+                             method=self.__request.get('method','POST'),
+                             data=data, headers=headers,
+                             total=load.get('total'), duration=load.get('duration'),
+                             concurrency=load.get('concurrency',1), rate=load.get('rate'),
+                             ramp_up=load.get('ramp_up',0))
+
+    def __handle_response(self, r, time_stamp, index):
+        if r is None:
+            self.workflows.drop(time_stamp)
+            return
+        if self.__expect_status:
+            ok = r.status_code in self.__expect_status
+        else:
+            ok = 200 <= r.status_code < 300
+        if not ok:
+            self.workflows.drop(time_stamp)
+        elif self.__completion:
+            self.workflows.produce(r.json()[self.__id_field], time_stamp)
+        else:
+            self.workflows.produce(index, time_stamp)
+            self.workflows.consume(index, time.time())
+
+    def __handle_message(self, body, message):
+        message.ack()
+        self.__handle_event(message.delivery_info.get('routing_key'), time.time())
+
+    def __handle_event(self, routing_key, time_stamp):
+        id_prefix = self.__completion.get('id_prefix')
+        if id_prefix and routing_key.startswith(id_prefix):
+            job_id = routing_key[len(id_prefix):]
+        else:
+            job_id = routing_key.rsplit('.', 1)[-1]
+        self.workflows.consume(job_id, time_stamp)
+
+    def __make_listener(self):
+        queue = completion_queue(self.__completion)
+        consumers = self.scenario.get('consumers', {})
+        processes = consumers.get('processes',0)
+        if processes > 0 and self.__amqp_url.startswith('memory://'):
+            # forked consumers would each get their own copy of the in-memory broker
+            print 'memory:// events only reach this process, ignoring consumers.processes={0}'.format(processes)
+            processes = 0
+        if processes > 0:
+            return AMQPConsumerPool(queue=queue, amqp_url=self.__amqp_url, callbacks=[self.__handle_event],
+                                    processes=processes,
+                                    prefetch=consumers.get('prefetch',1000),
+                                    ack_batch=consumers.get('ack_batch',100),
+                                    transport_options=self.__transport_options)
+        return AMQPWorker(queue=queue, amqp_url=self.__amqp_url, callbacks=[self.__handle_message],
+                          transport_options=self.__transport_options)
+
+    def clear_queue(self):
+        if not self.__completion:
+            return 0
+        queue = completion_queue(self.__completion)
+        print 'Clearing the {0} queue...'.format(queue.name)
+        discarded = drain_queue(queue, amqp_url=self.__amqp_url, transport_options=self.__transport_options)
+        print 'Discarded {0} stale messages'.format(discarded)
+        return discarded
+
+    def print_status(self):
+        print ("\r PostedWFs:{0} FinishedWFs:{1} DroppedWFs:{2} Tph:{3:.2f}wf/s avgTph:{4:.2f}wf/s max_wait={5:.2f}sec".
+               format(self.workflows.produced, self.workflows.consumed, self.workflows.dropped,
+                      self.throughput, self.agrigate_throughput, self.workflows.max_wait)),
+        sys.stdout.flush()
+
+    def analyze(self):
+        current_time = time.time()
+        consumed = self.workflows.consumed
+        last_time, last_consumed = self.__last_sample
+        delta_time = current_time - last_time
+        if delta_time > 0:
+            self.throughput = (consumed - last_consumed) / delta_time
+        if current_time > self.start_time:
+            self.agrigate_throughput = consumed / (current_time - self.start_time)
+        self.__last_sample = (current_time, consumed)
+
+    def __post(self):
+        self.__load_generator.start()
+        # every request is answered once the load generator returns
+        self.workflows.expect(self.workflows.produced + self.workflows.dropped)
+
+    def __wait_completion(self):
+        while not (self.workflows.completed.wait(1) or self.done.is_set()):
+            pass
+        self.done.set()
+        if self.__listener is not None:
+            self.__listener.stop()
+
+    def run(self):
+        self.start_time = time.time()
+        self.__last_sample = (self.start_time, self.workflows.consumed)
+        post_worker = Thread(target=self.__post)
+        completion_worker = Thread(target=self.__wait_completion)
+        analyzer_worker = PeriodicTask(self.analyze, self.__sampling_window)
+        printing_worker = PeriodicTask(self.print_status, 1.0 / self.__refresh_rate)
+        completion_worker.daemon = True
+        post_worker.daemon = True
+        if self.__completion:
+            self.__listener = self.__make_listener()
+        printing_worker.start()
+        analyzer_worker.start()
+        post_worker.start()
+        completion_worker.start()
+        try:
+            if self.__listener is not None:
+                self.__listener.start()
+            else:
+                while not self.done.wait(1):
+                    pass
+        finally:
+            self.done.set()
+            self.end_time = time.time()
+            analyzer_worker.stop()
+            printing_worker.stop()
+            self.__load_generator.stop()
+            self.__load_generator.close()
+            self.analyze()
+            self.print_status()
+
+    def stop(self):
+        self.done.set()
+        self.__load_generator.stop()
+        if self.__listener is not None:
+            self.__listener.stop()
+
+    def summary(self, params=None):
+        summary = self.workflows.summary()
+        summary['scenario'] = self.scenario.get('name')
+        summary['params'] = params
+        summary['start_time'] = self.start_time
+        summary['end_time'] = self.end_time
+        summary['duration'] = self.end_time - self.start_time
+        summary['avg_throughput'] = summary['finished'] / summary['duration'] if summary['duration'] > 0 else 0.0
+        return summary
+
+    def write_report(self, output, params=None):
+        if not self.end_time:
+            self.end_time = time.time()
+        summary = self.summary(params)
+        latency = summary['latency']
+        if latency['count']:
+            print ("\n latency: p50={0:.3f}s p90={1:.3f}s p99={2:.3f}s p99.9={3:.3f}s max={4:.3f}s".
+                   format(latency['p50'], latency['p90'], latency['p99'], latency['p99.9'], latency['max']))
+        if output:
+            self.workflows.series.write(output + '_series.csv')
+            self.workflows.series.write(output + '_series.json')
+            with open(output + '_summary.json', 'w') as f:
+                json.dump(summary, f, sort_keys=True, indent=4)
+            print ' report written to {0}_summary.json'.format(output)
+        return summary
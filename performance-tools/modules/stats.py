@@ -0,0 +1,128 @@
+from json import dump
+import csv
+import math
+
+"""
+Class to record latencies in an HDR style histogram
+Values (seconds) are counted in logarithmic buckets, each bucket being `precision`
+wider than the previous one, so any percentile is reported within that relative
+error using a few hundred counters whatever the number of values recorded.
+:param lowest: optional lowest distinguishable value in seconds
+:param precision: optional relative precision of the reported values
+"""
+class LatencyHistogram(object):
+    def __init__(self, lowest=0.0001, precision=0.01):
+        self.__lowest = lowest
+        self.__log_base = math.log(1.0 + precision)
+        self.__counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def __index(self, value):
+        if value < self.__lowest:
+            return 0
+        return int(math.log(value / self.__lowest) / self.__log_base) + 1
+
+    def __upper(self, index):
+        return self.__lowest * math.exp(index * self.__log_base)
+
+    def record(self, value):
+        index = self.__index(value)
+        self.__counts[index] = self.__counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(p / 100.0 * self.count)))
+        seen = 0
+        for index in sorted(self.__counts):
+            seen += self.__counts[index]
+            if seen >= rank:
+                return min(max(self.__upper(index), self.min), self.max)
+        return self.max
+
+    def summary(self, percentiles=(50, 90, 99, 99.9)):
+        out = {
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.mean()
+        }
+        for p in percentiles:
+            out['p{0:g}'.format(p)] = self.percentile(p)
+        return out
+
+"""
+Class to aggregate per-second throughput and latency samples
+Each second (epoch, truncated) holds its posted, finished and dropped workflow
+counts and the sum and max latency of the workflows finished during it.
+"""
+class TimeSeries(object):
+    FIELDS = ['time', 'elapsed', 'posted', 'finished', 'dropped', 'throughput', 'avg_latency', 'max_latency']
+
+    def __init__(self):
+        self.__seconds = {}
+
+    def __slot(self, time_stamp):
+        second = int(time_stamp)
+        slot = self.__seconds.get(second)
+        if slot is None:
+            slot = self.__seconds[second] = [0, 0, 0, 0.0, 0.0]
+        return slot
+
+    def posted(self, time_stamp):
+        self.__slot(time_stamp)[0] += 1
+
+    def finished(self, time_stamp, latency):
+        slot = self.__slot(time_stamp)
+        slot[1] += 1
+        slot[3] += latency
+        slot[4] = max(slot[4], latency)
+
+    def dropped(self, time_stamp):
+        self.__slot(time_stamp)[2] += 1
+
+    def rows(self):
+        if not self.__seconds:
+            return []
+        first = min(self.__seconds)
+        rows = []
+        for second in range(first, max(self.__seconds) + 1):
+            posted, finished, dropped, latency_sum, latency_max = self.__seconds.get(second, [0, 0, 0, 0.0, 0.0])
+            rows.append({
+                'time': second,
+                'elapsed': second - first,
+                'posted': posted,
+                'finished': finished,
+                'dropped': dropped,
+                'throughput': finished,
+                'avg_latency': latency_sum / finished if finished else None,
+                'max_latency': latency_max if finished else None
+            })
+        return rows
+
+    def write(self, path):
+        """
+        Write the series as CSV, or as JSON if path ends with .json
+        """
+        rows = self.rows()
+        with open(path, 'w') as f:
+            if path.endswith('.json'):
+                dump(rows, f, sort_keys=True)
+            else:
+                writer = csv.DictWriter(f, fieldnames=self.FIELDS)
+                writer.writeheader()
+                writer.writerows(rows)
@@ -0,0 +1,85 @@
+from stats import LatencyHistogram, TimeSeries
+from threading import Lock, Event
+import time
+
+"""
+Class to correlate posted workflows with their graph.finished events
+Each workflow is kept as a single post timestamp in a dict keyed by graph id,
+so both a post and a finish cost O(1) whatever the number of workflows.
+A graph may finish before its post is recorded, its finish timestamp is then
+kept until the post arrives.
+The end-to-end latency (post -> graph.finished) of every matched workflow is
+recorded in a LatencyHistogram and, with the counts, in a per-second TimeSeries.
+The counters are plain attributes, readers sample them without taking the lock.
+Once expect(total) is called, the completed event is set when all the workflows
+have been posted or dropped and none of them is in flight.
+"""
+class WorkflowTracker(object):
+    def __init__(self):
+        self.__lock = Lock()
+        self.__posted = {}
+        self.__finished = {}
+        self.produced = 0
+        self.consumed = 0
+        self.dropped = 0
+        self.max_wait = 0.0
+        self.latency = LatencyHistogram()
+        self.series = TimeSeries()
+        self.completed = Event()
+        self.__expected = None
+
+    def expect(self, total):
+        with self.__lock:
+            self.__expected = total
+            self.__check_completed()
+
+    def produce(self, graph_id, time_stamp):
+        with self.__lock:
+            self.produced += 1
+            self.series.posted(time_stamp)
+            finish_time = self.__finished.pop(graph_id, None)
+            if finish_time is None:
+                self.__posted[graph_id] = time_stamp
+            else:
+                self.__complete(finish_time, finish_time - time_stamp)
+            self.__check_completed()
+
+    def consume(self, graph_id, time_stamp):
+        with self.__lock:
+            self.consumed += 1
+            post_time = self.__posted.pop(graph_id, None)
+            if post_time is None:
+                self.__finished[graph_id] = time_stamp
+            else:
+                self.__complete(time_stamp, time_stamp - post_time)
+                self.__check_completed()
+
+    def drop(self, time_stamp=None):
+        with self.__lock:
+            self.dropped += 1
+            self.series.dropped(time_stamp or time.time())
+            self.__check_completed()
+
+    def in_flight(self):
+        return len(self.__posted)
+
+    def summary(self):
+        with self.__lock:
+            return {
+                'posted': self.produced,
+                'finished': self.consumed,
+                'dropped': self.dropped,
+                'in_flight': len(self.__posted),
+                'latency': self.latency.summary()
+            }
+
+    def __complete(self, finish_time, graph_wait):
+        self.latency.record(graph_wait)
+        self.series.finished(finish_time, graph_wait)
+        if self.max_wait < graph_wait:
+            self.max_wait = graph_wait
+
+    def __check_completed(self):
+        if self.__expected is not None and not self.__posted and \
+           self.produced + self.dropped >= self.__expected:
+            self.completed.set()
@@ -1,11 +1,13 @@
 
 from logger import Log
-from threading import Thread
-from datetime import datetime, timedelta
+from threading import Thread, Event, Condition
 import time
 
 LOG = Log(__name__)
 
+# monotonic clock for deadlines where available, wall clock otherwise
+clock = getattr(time, 'monotonic', time.time)
+
 """
 Class to abstract threaded worker subtasks
 :param id: node identifier
@@ -19,9 +21,13 @@ class WorkerThread(object):
         self.running = False
         self.start_time = 0
         self.timeout = False
+        self.done = Event()
 
 """
 Class to construct a threaded worker
+Each subtask signals its completion when its thread function returns, so
+wait_for_completion returns as soon as all the subtasks are done, or stops
+the remaining ones once timeout_sec (may be fractional, -1 for none) elapses.
 :param func: thread target function
 :param tasks: list of subtasks (WorkerThread)
 :param daemon: option to run task thread daemonized
@@ -31,41 +37,62 @@ class WorkerTasks(object):
         self.__func = kwargs.get('func')
         self.__tasks = kwargs.get('tasks')
         self.__daemon = kwargs.get('daemon',True)
+        self.__finished = Condition()
         if not isinstance(self.__tasks, list):
             raise TypeError('expected thread task list')
         if not hasattr(self.__func, '__call__'):
             raise TypeError('expected callable function')
 
     def __wait(self, timeout_sec):
-        while len(self.__tasks):
-            for task in self.__tasks:
-                elapsed_time = int(time.mktime(datetime.now().timetuple()) - task.start_time)
-                if timeout_sec != -1 and elapsed_time >= timeout_sec:
-                    LOG.warning('subtask timeout after {0} seconds, (id={1}), stopping..' \
-                        .format(elapsed_time,task.id))
-                    task.worker.stop()
-                    task.running = False
-                    task.timeout = True
-                if not task.running:
-                    self.__stop(task)
-            time.sleep(1)
+        deadline = None
+        if timeout_sec != -1:
+            deadline = clock() + timeout_sec
+        with self.__finished:
+            while any(task.running for task in self.__tasks):
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - clock()
+                    if remaining <= 0:
+                        self.__timeout()
+                        break
+                self.__finished.wait(remaining)
+        for task in list(self.__tasks):
+            self.__stop(task)
+
+    def __timeout(self):
+        for task in self.__tasks:
+            if task.running:
+                LOG.warning('subtask timeout after {0:.3f} seconds, (id={1}), stopping..' \
+                    .format(clock() - task.start_time,task.id))
+                task.worker.stop()
+                task.running = False
+                task.timeout = True
 
     def __stop(self, task):
         LOG.info('stopping subtask for {0}'.format(task.id))
         task.thread.join()
         try:
             self.__tasks.remove(task)
-        except IndexError:
-            LOG.error('index error while removing subtask from list!')
+        except ValueError:
+            LOG.error('error while removing subtask from list!')
+
+    def __target(self, task):
+        try:
+            self.__func(task.worker, task.id)
+        finally:
+            with self.__finished:
+                task.running = False
+                task.done.set()
+                self.__finished.notify_all()
 
     def __run(self):
         for task in self.__tasks:
-	        task.thread = Thread(target=self.__func, \
-                                     args=(task.worker,task.id,))
-	        task.thread.daemon = self.__daemon
-	        task.start_time = time.mktime(datetime.now().timetuple())
-	        task.running = True
-	        task.thread.start()
+            task.thread = Thread(target=self.__target, args=(task,))
+            task.thread.daemon = self.__daemon
+            task.start_time = clock()
+            task.running = True
+            task.done.clear()
+            task.thread.start()
 
     def run(self):
         self.__run()
@@ -73,3 +100,32 @@ class WorkerTasks(object):
     def wait_for_completion(self, timeout_sec=300):
         self.__wait(timeout_sec)
 
+"""
+Class to call a function at a fixed interval from a thread
+The thread sleeps on an event between calls, so it costs nothing while idle
+and stop() wakes it up immediately.
+:param func: function called every interval
+:param interval: seconds between two calls
+"""
+class PeriodicTask(object):
+    def __init__(self, func, interval):
+        self.__func = func
+        self.__interval = interval
+        self.__stopped = Event()
+        self.__thread = None
+
+    def __run(self):
+        while not self.__stopped.wait(self.__interval):
+            self.__func()
+
+    def start(self):
+        self.__stopped.clear()
+        self.__thread = Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
@@ -1,112 +1,46 @@
-import requests
-import json, time, sys
+import sys
 import signal
-from config.amqp import *
-from modules.amqp import AMQPWorker
-from proboscis.asserts import *
-from threading import Timer,Thread
-from decimal import *
-import textwrap
+import copy
 import argparse
-import time
-import sys
-from modules.worker import WorkerThread, WorkerTasks
+from modules.scenario import ScenarioRunner, DEFAULT_SCENARIO, load_scenario
+from modules.fakerackhd import FakeRackHD
+from modules.logger import enable_async_logging
 from argparse import RawTextHelpFormatter
 
-throughput= 0.0
-agrigateThroughput = 0.0
-start_time = 0
-done = False
-max_wait = 0.0
-time_to_clear_queue= 1
-consumed_workflows = []
-produced_workflows = []
-dropped_workflows = []
-
+runner = None
 
 def signal_handler(signum,stack):
-    global done
     print '  exiting..'
-    done = True
+    if runner is not None:
+        runner.stop()
     sys.exit(0)
 signal.signal(signal.SIGINT, signal_handler)
 
-def handle_graph_finish(body, message):
-    global consumed_workflows, produced_workflows, max_wait
-
-    temp_dict = {}
-    routeId = message.delivery_info.get('routing_key').split('graph.finished.')[1]
-    assert_not_equal(routeId, None)
-    message.ack()
-    temp_dict['time_stamp']= time.time()
-    temp_dict['graph_id']= routeId
-    consumed_workflows.append(temp_dict)
-    graph_wait = 0
-    for index, item in enumerate(produced_workflows):
-        if item["graph_id"] == routeId:
-            graph_wait =  temp_dict['time_stamp'] - item['time_stamp']
-            break
-    if (max_wait < graph_wait):
-        max_wait = graph_wait
-
-def post_function(TOTAL_WORKFLOWS):
-    global consumed_workflows, produced_workflows, dropped_workflow, start_time
-    start_time = time.time()
-    for n in range(TOTAL_WORKFLOWS):
-        temp_dict= {}
-        r = post('/workflows?name=Graph.noop-example')
-        graphId =  json.loads(r._content)["instanceId"]
-        temp_dict['time_stamp'] = time.time()
-        temp_dict['graph_id'] = graphId
-
-
-        if (r.status_code != 201):
-            dropped_workflows.append(temp_dict)
-        else:
-            produced_workflows.append(temp_dict)
-
-def print_function(REFRESH_RATE):
-    while 1:
-        if(done == False):
-            cw_length = len(consumed_workflows)
-            pw_length = len(produced_workflows)
-            dw_length = len(dropped_workflows)
-
-            if(type(agrigateThroughput) == float and type(throughput)  == float and type(max_wait) == float):
-                agrigateThroughput1 = "%.2f" % agrigateThroughput
-                throughput1 = "%.2f" % throughput
-                max_wait1 = "%.2f" % max_wait
-                print ("\r PostedWFs:{0} FinishedWFs:{1} DroppedWFs:{2} Tph:{3}wf/s avgTph:{4}wf/s max_wait={5}sec".
-                       format(pw_length, cw_length, dw_length, throughput1, agrigateThroughput1, max_wait1)),
-                sleep_time = 1.0 / REFRESH_RATE
-                time.sleep(sleep_time)
-        else:
-            break
-
-def analyze_function(TOTAL_WORKFLOWS, SAMPLING_WINDOW):
-    global consumed_workflows, produced_workflows, dropped_workflows, throughput, agrigateThroughput
-    global start_time, done
-    start_time = time.time()
-    lastTime = time.time()
-    last_consumed_workflows = len(consumed_workflows)
-    while 1:
-        currentTime = time.time()
-        deltaTime = currentTime -lastTime
-
-        cw_length = len(consumed_workflows)
-        pw_length = len(produced_workflows)
-        deltaWorkflows = cw_length - last_consumed_workflows
-
-        if( deltaTime >= SAMPLING_WINDOW and deltaWorkflows > 0 ):
-            lastTime = currentTime
-            throughput =  deltaWorkflows / (deltaTime)
-            last_consumed_workflows = cw_length
-            agrigateThroughput = cw_length/ (currentTime - start_time)
-
-
-        if(pw_length == TOTAL_WORKFLOWS and  cw_length == TOTAL_WORKFLOWS):
-            amqp_listner_worker.stop()
-            break
+def build_scenario(args):
+    if args.scenario:
+        scenario = load_scenario(args.scenario)
+    else:
+        scenario = copy.deepcopy(DEFAULT_SCENARIO)
+    load = scenario.setdefault('load', {})
+    consumers = scenario.setdefault('consumers', {})
+    # command line options override the scenario file
+    overrides = [
+        (load, 'total', args.total_workflows),
+        (load, 'duration', args.duration),
+        (load, 'concurrency', args.concurrency),
+        (load, 'rate', args.rate),
+        (load, 'ramp_up', args.ramp_up),
+        (scenario['request'], 'nodes', args.nodes.split(',') if args.nodes else None),
+        (consumers, 'processes', args.consumers),
+        (consumers, 'prefetch', args.prefetch),
+        (consumers, 'ack_batch', args.ack_batch)
+    ]
+    for section, key, value in overrides:
+        if value is not None:
+            section[key] = value
+    if args.duration is not None and args.total_workflows is None:
+        load.pop('total', None)
+    return scenario
 
 if __name__ == '__main__':
     if len(sys.argv) >= 0:
@@ -120,52 +54,100 @@ if __name__ == '__main__':
         Tph: Troughput, which is the number of workflows/sec that are being proccessed by RackHD
         avgTph: Average or aggregate throughput
         max_wait: Number of Seconds that the longest workflow had to wait in the queue before it got proccessed
+
+        At the end of the run the p50/p90/p99/p99.9 end-to-end workflow latencies (post -> graph.finished) are
+        printed. With --output, the per-second throughput and latency series are written to <output>_series.csv
+        and <output>_series.json, and a machine-readable summary of the run to <output>_summary.json
+
+        By default Graph.noop-example workflows are posted to API 1.1 and completed by graph.finished events.
+        With --scenario, a JSON/YAML scenario file declares the requests (any graph, node targets, API 2.0),
+        the AMQP completion events, the load and the consumers; see modules/scenario.py and scenarios/.
+        The load and consumer options below override the values of the scenario.
+
+        With --fake_rackhd, the benchmark runs against a local RackHD stand-in (modules/fakerackhd.py) started in
+        this process, which publishes graph.finished events after a simulated service time. Events go through the
+        in-memory kombu transport unless --amqp_url is given, so no RackHD or RabbitMQ is needed.
         """)
+        parser.add_argument('-S','--scenario', default=None, required=False,
+                            help="JSON or YAML scenario file, default: Graph.noop-example scenario")
         parser.add_argument('-RR','--refresh_rate', type=int, default=15, required=False,
                             help="The refresh rate of the screen(per sec), default value is 15")
-        parser.add_argument('-TF','--total_workflows', type=int, default=20, required=False,
-                            help="Total number of workflows that will be posted, default value is: 20")
+        parser.add_argument('-TF','--total_workflows', type=int, default=None, required=False,
+                            help="Total number of workflows that will be posted, default: load.total of the\n"
+                                 "scenario (20 for the default scenario), unbounded when only --duration is given")
+        parser.add_argument('-D','--duration', type=float, default=None, required=False,
+                            help="Seconds during which workflows are posted, without --total_workflows the\n"
+                                 "load is only bounded by the duration")
+        parser.add_argument('-N','--nodes', default=None, required=False,
+                            help="Comma separated node ids the {node} requests of the scenario are issued against,\n"
+                                 "overrides request.nodes of the scenario")
         parser.add_argument('-H','--host', default='localhost:8080', required=False,
                             help="RackHD IP:PORT, default is: localhost:8080 ")
+        parser.add_argument('-A','--amqp_url', default=None, required=False,
+                            help="AMQP URL of RackHD, default is: amqp://localhost")
+        parser.add_argument('-C','--concurrency', type=int, default=None, required=False,
+                            help="Number of concurrent posting threads. Without --rate each thread keeps one\n"
+                                 "workflow post in flight (closed loop), default value is: 1")
+        parser.add_argument('-R','--rate', type=float, default=None, required=False,
+                            help="Target rate of workflow posts in wf/s. Posts are scheduled at this rate\n"
+                                 "whatever the response time (open loop), default: closed loop")
+        parser.add_argument('-RU','--ramp_up', type=float, default=None, required=False,
+                            help="Seconds over which the load grows linearly to its target, default value is: 0")
         parser.add_argument('-SW','--sampling_window', type=int, default=3.0, required=False,
                             help="The period over which it is used to calculate the throughput, default value: 3.0 sec")
+        parser.add_argument('-CP','--consumers', type=int, default=None, required=False,
+                            help="Number of graph.finished consumer processes with batched acks, default value is: 0\n"
+                                 "(a single consumer in the main process acking every message)")
+        parser.add_argument('-PF','--prefetch', type=int, default=None, required=False,
+                            help="Prefetch count of each consumer process, default value is: 1000")
+        parser.add_argument('-AB','--ack_batch', type=int, default=None, required=False,
+                            help="Number of messages acknowledged at once by each consumer process, default value is: 100")
+        parser.add_argument('-F','--fake_rackhd', action='store_true', required=False,
+                            help="Benchmark a local RackHD stand-in instead of --host")
+        parser.add_argument('-FS','--fake_service_time', default='exp:0.01', required=False,
+                            help="Service time distribution of the stand-in graphs: const:<t>, exp:<mean>,\n"
+                                 "uniform:<min>,<max> or lognormal:<mu>,<sigma>, default: exp:0.01")
+        parser.add_argument('-FF','--fake_failure_rate', type=float, default=0.0, required=False,
+                            help="Fraction of workflow posts failing on the stand-in, default value is: 0")
+        parser.add_argument('-FW','--fake_workers', type=int, default=4, required=False,
+                            help="Number of graphs the stand-in runs concurrently, default value is: 4")
+        parser.add_argument('-AL','--async_logging', action='store_true', required=False,
+                            help="Write log records from a background thread so logging never blocks the consumer")
+        parser.add_argument('-O','--output', default=None, required=False,
+                            help="Path prefix of the series and summary files written at the end of the run")
         args = parser.parse_args()
 
-        REFRESH_RATE = args.refresh_rate
-        TOTAL_WORKFLOWS = args.total_workflows
-        HOST = args.host
-        SAMPLING_WINDOW = args.sampling_window
-
-    amqp_listner_worker = AMQPWorker(queue=QUEUE_GRAPH_FINISH, callbacks=[handle_graph_finish])
-    BASE_URL = 'http://{0}/api/1.1'.format(HOST)
-
-    def post(path, data=None, headers=None):
-        return requests.post(BASE_URL + path, data, headers=headers)
-
-    def thread_func(worker, id):
-        worker.start()
-
-    def run():
-        post_worker = Thread(target=post_function,args=(TOTAL_WORKFLOWS,))
-        analyzer_worker = Thread(target=analyze_function, args=(TOTAL_WORKFLOWS,SAMPLING_WINDOW))
-        printing_worker = Thread(target=print_function, args=[REFRESH_RATE])
-        printing_worker.daemon = True
-        analyzer_worker.daemon = True
-        post_worker.daemon = True
-        printing_worker.start()
-        analyzer_worker.start()
-        post_worker.start()
-        amqp_listner_worker.start()
-
-    def clear_queue():
-        task = WorkerThread(amqp_listner_worker, 'amqp')
-        tasks = WorkerTasks(tasks=[task], func=thread_func)
-        print'Clearing the graph.finished queue...'
-        tasks.run()
-        tasks.wait_for_completion(time_to_clear_queue)
-
-    clear_queue()
-    run()
+    if args.async_logging:
+        enable_async_logging()
+
+    host = args.host
+    amqp_url = args.amqp_url
+    transport_options = None
+    fake = None
+    if args.fake_rackhd:
+        amqp_url = amqp_url or 'memory://'
+        fake = FakeRackHD(amqp_url=amqp_url, service_time=args.fake_service_time,
+                          failure_rate=args.fake_failure_rate, workers=args.fake_workers)
+        fake.start()
+        host = fake.address
+        if amqp_url.startswith('memory://'):
+            # the in-memory transport polls its queues, once a second by default
+            transport_options = {'polling_interval': 0.001}
+
+    try:
+        runner = ScenarioRunner(build_scenario(args), host,
+                                refresh_rate=args.refresh_rate, sampling_window=args.sampling_window,
+                                amqp_url=amqp_url, transport_options=transport_options)
+    except ValueError as e:
+        print e
+        if fake is not None:
+            fake.stop()
+        sys.exit(1)
+    runner.clear_queue()
+    try:
+        runner.run()
+    finally:
+        runner.write_report(args.output, vars(args))
+        if fake is not None:
+            fake.stop()
     sys.exit(0)
-
-
@@ -11,11 +11,23 @@ import atexit
 import sys
 import shutil
 import re
-import urllib
+import urllib2
+import httplib
+import socket
+import urlparse
+import hashlib
+import json
+import threading
+import time
+import stat
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
 
 tmpdir = ''
+staging = ''
 VERBOSE = 0
 DEBUG = 1
+COPY_BUFSIZE = 1024 * 1024
 
 # Cleanup
 
@@ -25,6 +37,9 @@ def cleanup_tmp():
     if tmpdir != '':
         subprocess.check_call(['umount', '-l', tmpdir])
         os.rmdir(tmpdir)
+    if staging != '' and os.path.isdir(staging):
+        make_writable(staging)
+        shutil.rmtree(staging)
 
 
 def get_iso_info(fname):
@@ -33,6 +48,18 @@ def get_iso_info(fname):
     return label1.stdout.read()
 
 
+def get_volume_info(fname):
+    # Read the primary volume descriptor (sector 16) of the ISO in process, the fields
+    # determine_os_ver looks at are returned in the format of `isoinfo -d`
+    with open(fname, 'rb') as f:
+        f.seek(16 * 2048)
+        descriptor = f.read(2048)
+    if len(descriptor) < 2048 or descriptor[0] != '\x01' or descriptor[1:6] != 'CD001':
+        return ''
+    return 'System id: {0}\nVolume id: {1}\nApplication id: {2}\n'.format(
+        descriptor[8:40].strip(), descriptor[40:72].strip(), descriptor[574:702].strip())
+
+
 def get_setup_exe_name_version(srcdir):
     # To get the name and version from setup.exe
     os.chdir(srcdir)
@@ -52,7 +79,210 @@ def get_setup_exe_name_version(srcdir):
     return osname, osver
 
 
-def do_setup_repo(osname, osver, src, dest, link):
+def file_sha256(path, chunk_size=1024 * 1024):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class DedupIndex(object):
+    # Index of the files already installed under the destination directory, so that a
+    # file with the same content is linked to one of them instead of being copied.
+    # Files are only hashed when another file has the same size, the hashes are kept in
+    # <dest>/.dedup-index.json with the file size and mtime to skip them next time.
+    INDEX_FILE = '.dedup-index.json'
+
+    def __init__(self, root, mode='hardlink'):
+        self.root = root
+        self.mode = mode
+        self.index_path = os.path.join(root, self.INDEX_FILE)
+        self.hashes = {}
+        self.by_size = {}
+        self.linked = 0
+        self.bytes_saved = 0
+        self.lock = threading.Lock()
+        try:
+            with open(self.index_path) as f:
+                self.hashes = json.load(f)
+        except (IOError, ValueError):
+            pass
+        for dirpath, dirnames, filenames in os.walk(root):
+            # skip the hidden directories, e.g. an ISO being extracted
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if path != self.index_path and os.path.isfile(path) and not os.path.islink(path):
+                    self.by_size.setdefault(os.path.getsize(path), []).append(path)
+
+    def hash(self, path):
+        st = os.stat(path)
+        key = os.path.relpath(path, self.root)
+        cached = self.hashes.get(key)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime:
+            return cached[2]
+        digest = file_sha256(path)
+        with self.lock:
+            self.hashes[key] = [st.st_size, st.st_mtime, digest]
+        return digest
+
+    def find(self, src, size):
+        # return an installed file with the same content as src, or None
+        candidates = self.by_size.get(size)
+        if not candidates:
+            return None
+        digest = file_sha256(src)
+        for candidate in list(candidates):
+            try:
+                if self.hash(candidate) == digest:
+                    return candidate
+            except (OSError, IOError):
+                # removed or replaced since it was indexed
+                with self.lock:
+                    if candidate in candidates:
+                        candidates.remove(candidate)
+                    self.hashes.pop(os.path.relpath(candidate, self.root), None)
+        return None
+
+    def link(self, existing, dst):
+        try:
+            if self.mode == 'reflink':
+                with open(os.devnull, 'w') as devnull:
+                    subprocess.check_call(['cp', '--reflink=always', '--preserve=all', existing, dst],
+                                          stderr=devnull)
+            else:
+                os.link(existing, dst)
+        except (OSError, subprocess.CalledProcessError):
+            # other filesystem, too many links, or no reflink support
+            return False
+        return True
+
+    def install(self, src, dst, move=False):
+        # link or copy (or move) src to dst, return the number of bytes copied
+        size = os.path.getsize(src)
+        existing = self.find(src, size)
+        copied = 0
+        if existing and self.link(existing, dst):
+            with self.lock:
+                self.linked += 1
+                self.bytes_saved += size
+        elif move:
+            os.rename(src, dst)
+        else:
+            copied = copy_file(src, dst)
+        with self.lock:
+            self.by_size.setdefault(size, []).append(dst)
+        return copied
+
+    def save(self):
+        with open(self.index_path, 'w') as f:
+            json.dump(self.hashes, f)
+
+
+def copy_file(src, dst):
+    # Copy src to dst with its metadata in COPY_BUFSIZE reads and writes,
+    # return the number of bytes copied
+    copied = 0
+    fsrc = os.open(src, os.O_RDONLY)
+    try:
+        fdst = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            while True:
+                buf = os.read(fsrc, COPY_BUFSIZE)
+                if not buf:
+                    break
+                while buf:
+                    n = os.write(fdst, buf)
+                    buf = buf[n:]
+                    copied += n
+        finally:
+            os.close(fdst)
+    finally:
+        os.close(fsrc)
+    shutil.copystat(src, dst)
+    return copied
+
+
+class CopyProgress(object):
+    # Aggregate throughput of the copy threads, printed at most once a second when VERBOSE
+    def __init__(self, total_files, total_bytes):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.last_print = self.start
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.files = 0
+        self.bytes = 0
+
+    def update(self, copied):
+        with self.lock:
+            self.files += 1
+            self.bytes += copied
+            now = time.time()
+            if VERBOSE and now - self.last_print >= 1:
+                self.last_print = now
+                status = r"%6d/%d files %10d/%d bytes  %8.2f MB/s" % (self.files, self.total_files, self.bytes,
+                                                                     self.total_bytes, self.rate())
+                status = status + chr(8) * (len(status) + 1)
+                print status,
+
+    def rate(self):
+        elapsed = time.time() - self.start
+        return self.bytes / elapsed / (1024 * 1024) if elapsed > 0 else 0.0
+
+    def done(self):
+        print 'Installed {0} files, copied {1} bytes in {2:.1f}s ({3:.2f} MB/s)'.format(
+            self.files, self.bytes, time.time() - self.start, self.rate())
+
+
+def copy_tree(src, dst, symlinks=False, dedup=None, jobs=8, move=False):
+    # Same as shutil.copytree, the tree is walked once to create the directories and
+    # symlinks, then the files are copied (or installed through dedup) by jobs threads.
+    # With move, src is a scratch tree on the same filesystem (an extracted ISO), it is
+    # renamed to dst, or its files are when they go through dedup
+    if move:
+        if not os.path.isdir(os.path.dirname(dst)):
+            os.makedirs(os.path.dirname(dst))
+        if dedup is None:
+            os.rename(src, dst)
+            return
+        symlinks = True
+    dirs = []
+    files = []
+    total_bytes = 0
+    for dirpath, dirnames, filenames in os.walk(src, followlinks=not symlinks):
+        dstdir = os.path.normpath(os.path.join(dst, os.path.relpath(dirpath, src)))
+        os.makedirs(dstdir)
+        dirs.append((dirpath, dstdir))
+        for name in filenames + [d for d in dirnames if symlinks and os.path.islink(os.path.join(dirpath, d))]:
+            srcname = os.path.join(dirpath, name)
+            dstname = os.path.join(dstdir, name)
+            if symlinks and os.path.islink(srcname):
+                os.symlink(os.readlink(srcname), dstname)
+            else:
+                files.append((srcname, dstname))
+                total_bytes += os.path.getsize(srcname)
+
+    progress = CopyProgress(len(files), total_bytes)
+    install = copy_file
+    if dedup is not None:
+        install = lambda srcname, dstname: dedup.install(srcname, dstname, move)
+    pool = ThreadPool(max(1, jobs))
+    try:
+        pool.map(lambda (srcname, dstname): progress.update(install(srcname, dstname)), files)
+    finally:
+        pool.close()
+        pool.join()
+    progress.done()
+
+    # directories of a mounted ISO are read-only, set their mode once they are filled
+    for dirpath, dstdir in reversed(dirs):
+        shutil.copystat(dirpath, dstdir)
+
+
+def do_setup_repo(osname, osver, src, dest, link, dedup=None, jobs=8, iso=None):
+    # iso is the ISO file when src is the ISO extracted under dest rather than mounted
     print 'Installing {0} {1} to {2}/{0}/{1}'.format(osname, osver, dest)
     print 'symbolic link base directory {0}'.format(link)
     dstpath = dest + '/' + osname + '/' + osver
@@ -66,10 +296,13 @@ def do_setup_repo(osname, osver, src, dest, link):
         if os.path.isfile(src + '/isolinux/initrd0.img'):
             initrd = 'initrd0.img'
             vmlinuz = 'vmlinuz0'
-        mount1 = subprocess.Popen(['mount'], stdout=subprocess.PIPE)
-        mount2 = subprocess.Popen(['grep', src], stdin=mount1.stdout, stdout=subprocess.PIPE)
-        mount3 = subprocess.Popen(['awk', '{print $1}'], stdin=mount2.stdout, stdout=subprocess.PIPE)
-        isoname = mount3.communicate()[0]
+        if iso:
+            isoname = os.path.abspath(iso)
+        else:
+            mount1 = subprocess.Popen(['mount'], stdout=subprocess.PIPE)
+            mount2 = subprocess.Popen(['grep', src], stdin=mount1.stdout, stdout=subprocess.PIPE)
+            mount3 = subprocess.Popen(['awk', '{print $1}'], stdin=mount2.stdout, stdout=subprocess.PIPE)
+            isoname = mount3.communicate()[0]
 
         iso_basename = os.path.basename(isoname).strip()
         iso_dirname = os.path.dirname(isoname).strip()
@@ -84,10 +317,14 @@ def do_setup_repo(osname, osver, src, dest, link):
         shutil.copyfile(src + '/isolinux/' + vmlinuz, dstpath + '/' + vmlinuz)
 
     elif osname is 'Ubuntu':
-        shutil.copytree(src, dstpath, symlinks=True)
+        copy_tree(src, dstpath, symlinks=True, dedup=dedup, jobs=jobs, move=iso is not None)
 
     else:
-        shutil.copytree(src, dstpath)
+        copy_tree(src, dstpath, dedup=dedup, jobs=jobs, move=iso is not None)
+
+    if dedup is not None:
+        dedup.save()
+        print 'Linked {0} files already installed, {1} bytes saved'.format(dedup.linked, dedup.bytes_saved)
 
     os.system('ln -sf ' + dest + "/" + osname + ' ' + link + '/on-http/static/http/')
     os.system('ln -sf ' + dest + "/" + osname + ' ' + link + '/on-tftp/static/tftp/')
@@ -111,6 +348,36 @@ def mount_iso(fname):
     return tmpdir
 
 
+def make_writable(path):
+    # the directories of an extracted ISO are read-only, as on the ISO
+    for dirpath, dirnames, filenames in os.walk(path):
+        os.chmod(dirpath, os.stat(dirpath).st_mode | stat.S_IWUSR)
+
+
+def extract_iso(fname, dest):
+    # Extract the ISO to a new hidden directory under dest without mounting it, in one
+    # sequential read of the image with bsdtar (libarchive reads ISO9660, Joliet and
+    # Rock Ridge), or with xorriso
+    extractdir = tempfile.mkdtemp(prefix='.setup_iso-', dir=dest)
+    if find_executable('bsdtar'):
+        command = ['bsdtar', '-x', '-f', fname, '-C', extractdir]
+    elif find_executable('xorriso'):
+        command = ['xorriso', '-osirrox', 'on', '-indev', fname, '-extract', '/', extractdir]
+    else:
+        print 'bsdtar or xorriso is required to extract the ISO image'
+        os.rmdir(extractdir)
+        return ''
+    try:
+        subprocess.check_call(command)
+    except subprocess.CalledProcessError as e:
+        print 'Failed with error code: {0}'.format(e.returncode)
+        make_writable(extractdir)
+        shutil.rmtree(extractdir)
+        return ''
+    make_writable(extractdir)
+    return extractdir
+
+
 def determine_os_ver(srcdir, iso_info):
     osname = ''
     osver = ''
@@ -183,10 +450,187 @@ def show_progress(a, b, file_size):
         print status,
 
 
+def get_sha256sum(sums, filename, timeout=120):
+    # Look filename up in a SHA256SUMS file (path or URL) of "<sha256> [*]<filename>" lines
+    if os.path.isfile(sums):
+        with open(sums) as f:
+            lines = f.read().splitlines()
+    else:
+        lines = urllib2.urlopen(sums, timeout=timeout).read().splitlines()
+    for line in lines:
+        fields = line.split(None, 1)
+        if len(fields) == 2 and os.path.basename(fields[1].lstrip('*')) == filename:
+            return fields[0].lower()
+    return None
+
+
+class IsoDownload(object):
+    # Download of an ISO image to the cache directory, the file name is a hash of the URL and
+    # of the expected SHA256 so the same image is only downloaded once. When the server
+    # accepts range requests, the image is fetched in `segments` ranges at the same time.
+    # The ranges downloaded so far are saved next to the partial file, so an interrupted
+    # download resumes where it stopped the next time. The SHA256 is verified before the
+    # partial file is renamed, a partial file failing it is removed.
+    # A range whose connection fails or stalls for `timeout` seconds is requested again
+    # from where it stopped, up to RETRIES times.
+    CHUNK_SIZE = 1024 * 1024
+    RETRIES = 3
+
+    def __init__(self, url, cache_dir, sha256=None, segments=4, timeout=120):
+        self.url = url
+        self.timeout = timeout
+        self.sha256 = sha256.lower() if sha256 else None
+        self.segments = max(1, segments)
+        key = hashlib.sha256(url + '\0' + (self.sha256 or '')).hexdigest()[:16]
+        filename = os.path.basename(urlparse.urlparse(url).path) or 'image.iso'
+        self.path = os.path.join(cache_dir, key + '-' + filename)
+        self.part_path = self.path + '.part'
+        self.state_path = self.path + '.part.json'
+        self.lock = threading.Lock()
+        self.state = None
+        self.last_save = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def head(self):
+        request = urllib2.Request(self.url)
+        request.get_method = lambda: 'HEAD'
+        response = urllib2.urlopen(request, timeout=self.timeout)
+        size = response.info().getheader('Content-Length')
+        ranges = response.info().getheader('Accept-Ranges', '') == 'bytes'
+        validator = response.info().getheader('ETag') or response.info().getheader('Last-Modified')
+        response.close()
+        return int(size) if size else None, ranges, validator
+
+    def load_state(self, size, validator):
+        # the ranges saved by an interrupted download of the same image, if any
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if state['size'] != size or state['validator'] != validator or not os.path.isfile(self.part_path):
+            return None
+        return state
+
+    def save_state(self, force=False):
+        # called with the lock held, at most once a second unless forced. The saved offsets
+        # only cover data already flushed to the partial file, a forced save syncs it first
+        now = time.time()
+        if force or now - self.last_save >= 1:
+            self.last_save = now
+            if force:
+                fd = os.open(self.part_path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            with open(self.state_path + '.tmp', 'w') as f:
+                json.dump(self.state, f)
+            os.rename(self.state_path + '.tmp', self.state_path)
+
+    def fetch_segment(self, segment):
+        for attempt in range(self.RETRIES + 1):
+            try:
+                return self.fetch_range(segment)
+            except (IOError, socket.timeout, httplib.HTTPException) as e:
+                if attempt == self.RETRIES:
+                    raise
+                print 'Retrying {0} from {1}: {2}'.format(self.url, segment[0], e)
+                time.sleep(2 ** attempt)
+
+    def fetch_range(self, segment):
+        # segment is [next offset, end offset (inclusive)], updated as the data is written
+        if segment[0] > segment[1]:
+            return
+        request = urllib2.Request(self.url, headers={'Range': 'bytes={0}-{1}'.format(segment[0], segment[1])})
+        response = urllib2.urlopen(request, timeout=self.timeout)
+        if response.getcode() != 206:
+            raise IOError('{0} ignored the range request'.format(self.url))
+        with open(self.part_path, 'r+b') as f:
+            f.seek(segment[0])
+            while segment[0] <= segment[1]:
+                data = response.read(min(self.CHUNK_SIZE, segment[1] - segment[0] + 1))
+                if not data:
+                    raise IOError('{0} closed the connection at {1}'.format(self.url, segment[0]))
+                f.write(data)
+                # the offset may be saved by any thread, it must not cover buffered data
+                f.flush()
+                with self.lock:
+                    segment[0] += len(data)
+                    self.state['done'] += len(data)
+                    show_progress(self.state['done'], 1, self.state['size'])
+                    self.save_state()
+
+    def fetch_ranges(self, size, validator):
+        self.state = self.load_state(size, validator)
+        if self.state is None:
+            step = (size + self.segments - 1) / self.segments
+            self.state = {'size': size, 'validator': validator, 'done': 0,
+                          'segments': [[start, min(start + step, size) - 1] for start in range(0, size, step)]}
+            with open(self.part_path, 'wb') as f:
+                f.truncate(size)
+        else:
+            print 'Resuming download of {0} at {1} bytes'.format(self.url, self.state['done'])
+        pool = ThreadPool(len(self.state['segments']))
+        try:
+            pool.map(self.fetch_segment, self.state['segments'])
+        finally:
+            pool.close()
+            pool.join()
+            with self.lock:
+                self.save_state(force=True)
+
+    def fetch_stream(self):
+        response = urllib2.urlopen(self.url, timeout=self.timeout)
+        size = int(response.info().getheader('Content-Length') or 0)
+        done = 0
+        with open(self.part_path, 'wb') as f:
+            for data in iter(lambda: response.read(self.CHUNK_SIZE), ''):
+                f.write(data)
+                done += len(data)
+                show_progress(done, 1, size or done)
+
+    def download(self):
+        # Return the path of the downloaded image
+        if os.path.isfile(self.path):
+            print 'Using {0} downloaded before'.format(self.path)
+            return self.path
+        size, ranges, validator = self.head()
+        if size and ranges:
+            self.fetch_ranges(size, validator)
+        else:
+            self.fetch_stream()
+        print '\n'
+        if self.sha256:
+            digest = file_sha256(self.part_path)
+            if digest != self.sha256:
+                os.remove(self.part_path)
+                if os.path.exists(self.state_path):
+                    os.remove(self.state_path)
+                raise IOError('SHA256 of {0} is {1}, expected {2}'.format(self.url, digest, self.sha256))
+        os.rename(self.part_path, self.path)
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+        return self.path
+
+
 parser = argparse.ArgumentParser(description='Setup the OS repo from an ISO image')
 parser.add_argument('iso', metavar='N', help='the ISO image or URL to ISO image')
 parser.add_argument('dest', metavar='N', help='the destination directory to setup')
 parser.add_argument('--link', metavar='N', help='the symbolic link path', default='/var/renasar')
+parser.add_argument('--dedup', choices=['hardlink', 'reflink'],
+                    help='link the files identical to the ones already installed in the destination directory')
+parser.add_argument('--jobs', type=int, default=8, help='the number of files copied at the same time')
+parser.add_argument('--extract', action='store_true',
+                    help='extract the ISO image with bsdtar or xorriso instead of mounting it, no root required')
+parser.add_argument('--sha256', help='the expected SHA256 of the downloaded ISO image')
+parser.add_argument('--sha256sums', help='a SHA256SUMS file or URL listing the SHA256 of the ISO image')
+parser.add_argument('--cache', default=os.path.expanduser('~/.cache/setup_iso'),
+                    help='the directory the downloaded ISO images are kept in')
+parser.add_argument('--segments', type=int, default=4, help='the number of ranges downloaded at the same time')
+parser.add_argument('--timeout', type=int, default=120,
+                    help='the seconds a download connection may stall before it is retried')
 args = parser.parse_args()
 
 
@@ -195,24 +639,44 @@ fname = ''
 if os.path.isfile(args.iso) and os.access(args.iso, os.R_OK):
     fname = args.iso
 else:
-    (filename, headers) = urllib.urlretrieve(url=args.iso, reporthook=show_progress)
-    print '\n'
-    fname = filename
+    sha256 = args.sha256
+    if not sha256 and args.sha256sums:
+        sha256 = get_sha256sum(args.sha256sums, os.path.basename(urlparse.urlparse(args.iso).path), args.timeout)
+        if not sha256:
+            print 'Failed to find the ISO image in {0}'.format(args.sha256sums)
+            sys.exit(1)
+    try:
+        fname = IsoDownload(args.iso, args.cache, sha256, args.segments, args.timeout).download()
+    except (IOError, socket.timeout, httplib.HTTPException) as e:
+        print 'Failed to download ISO image: {0}'.format(e)
+        sys.exit(1)
 
-tmpdir = mount_iso(fname)
-if not tmpdir:
-    print 'Failed to mount ISO image'
-    sys.exit(1)
+if args.extract:
+    if not os.path.isdir(args.dest):
+        os.makedirs(args.dest)
+    srcdir = staging = extract_iso(os.path.abspath(fname), os.path.abspath(args.dest))
+    if not staging:
+        print 'Failed to extract ISO image'
+        sys.exit(1)
+    info = get_volume_info(fname)
+else:
+    srcdir = tmpdir = mount_iso(fname)
+    if not tmpdir:
+        print 'Failed to mount ISO image'
+        sys.exit(1)
+    info = get_iso_info(fname)
 
-info = get_iso_info(fname)
 if not info:
     print 'Failed to get iso info'
     sys.exit(1)
 
 
-osname, osver = determine_os_ver(tmpdir, info)
+osname, osver = determine_os_ver(srcdir, info)
 if not osname or not osver:
     print 'Failed to get os name and/or os version information'
     sys.exit(1)
 
-do_setup_repo(osname, osver, tmpdir, args.dest, args.link)
+dedup = None
+if args.dedup:
+    dedup = DedupIndex(args.dest, args.dedup)
+do_setup_repo(osname, osver, srcdir, args.dest, args.link, dedup, args.jobs, fname if args.extract else None)
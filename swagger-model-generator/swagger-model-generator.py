@@ -3,25 +3,52 @@ import re
 import json
 import os
 import sys
+import hashlib
+import argparse
+import multiprocessing
 import yaml
 
-dir = '.'
-root_fname = ''
+cache_dir = './.schema-cache'
+# bump when modify_key_ref changes, so cached schemas are processed again
+cache_version = '1'
 need_flatten = {}
 definitions = {}
 
-def flatten_ref(obj):
-    for key in obj.keys():
-        if key == "$ref":
-            if obj[key] in need_flatten:
-                #sys.stderr.write('flattening ' + obj[key] +'\n')
-                refptr = need_flatten[obj[key]]
-                del obj[key]
-                for key2 in refptr:
-                    obj[key2] = refptr[key2]
+def resolve_refs(obj, resolved, resolving):
+    # return a copy of obj where every $ref to a definition without properties
+    # is replaced by the (itself resolved) content of that definition
+    if isinstance(obj, dict):
+        out = {}
+        for key in obj:
+            if key != "$ref":
+                out[key] = resolve_refs(obj[key], resolved, resolving)
+        if "$ref" in obj:
+            target = resolve_flatten_ref(obj["$ref"], resolved, resolving)
+            if target is None:
+                out["$ref"] = obj["$ref"]
+            else:
+                out.update(target)
+        return out
+    if isinstance(obj, list):
+        return [resolve_refs(item, resolved, resolving) for item in obj]
     return obj
 
-def modify_key_ref(obj):
+def resolve_flatten_ref(ref, resolved, resolving):
+    # each flattened definition is resolved once and memoized in resolved,
+    # a $ref back to a definition being resolved is a cycle and is kept as is
+    if ref not in need_flatten:
+        return None
+    if ref in resolved:
+        return resolved[ref]
+    if ref in resolving:
+        sys.stderr.write('  cyclic $ref ' + ref + ' left unresolved\n')
+        return None
+    resolving.add(ref)
+    resolved[ref] = resolve_refs(need_flatten[ref], resolved, resolving)
+    resolving.discard(ref)
+    return resolved[ref]
+
+def modify_key_ref(obj, root_fname):
     for key in obj.keys():
         if key in ['longDescription', 'enumDescriptions', 'patternProperties', 'additionalProperties', 'requiredOnCreate']:
             # do not output these fields yet, unused right now
@@ -52,53 +79,109 @@ def modify_key_ref(obj):
                     obj[key] = '#/definitions/' + root_fname + '_' + m.group(1)
     return obj
 
-def load_directory(dir):
-    global root_fname
-    for fname in os.listdir(dir):
-        if '.json' not in fname:
-            continue
-
-        root_fname = fname[:-5]
-        fpath = os.path.join(dir, fname)
-
-        sys.stderr.write('Processing ' + dir + '/' + root_fname + '...\n')
-
-        with open(fpath, 'r') as file_handle:
-            json_dict = json.load(file_handle, object_hook=modify_key_ref)
-            try:
-                for key in json_dict['definitions']:
-                    if 'properties' not in json_dict['definitions'][key]:
-                        need_flatten['#/definitions/' + root_fname +'_'+key] = json_dict['definitions'][key]
-                    else:
-                        definitions[root_fname+'_'+key] = json_dict['definitions'][key]
-            except:
-                sys.stderr.write('  Failed to process\n')
-
-class noalias_dumper(yaml.SafeDumper):
+def load_file(fpath):
+    # parse one schema file, only depends on its name and content so that the
+    # files can be processed in parallel and the results cached by content hash
+    root_fname = os.path.basename(fpath)[:-5]
+    with open(fpath, 'rb') as file_handle:
+        content = file_handle.read()
+    digest = hashlib.sha256(cache_version + '\0' + root_fname + '\0' + content).hexdigest()
+    cache_path = os.path.join(cache_dir, digest + '.json')
+    try:
+        with open(cache_path, 'r') as cache_handle:
+            sys.stderr.write('Processing ' + fpath + ' (cached)...\n')
+            return json.load(cache_handle)
+    except (IOError, ValueError):
+        pass
+
+    sys.stderr.write('Processing ' + fpath + '...\n')
+    result = {'need_flatten': {}, 'definitions': {}}
+    json_dict = json.loads(content, object_hook=lambda obj: modify_key_ref(obj, root_fname))
+    try:
+        for key in json_dict['definitions']:
+            if 'properties' not in json_dict['definitions'][key]:
+                result['need_flatten']['#/definitions/' + root_fname +'_'+key] = json_dict['definitions'][key]
+            else:
+                result['definitions'][root_fname+'_'+key] = json_dict['definitions'][key]
+    except:
+        sys.stderr.write('  Failed to process ' + fpath + '\n')
+
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            pass
+    tmp_path = cache_path + '.' + str(os.getpid())
+    with open(tmp_path, 'w') as cache_handle:
+        json.dump(result, cache_handle)
+    os.rename(tmp_path, cache_path)
+    return result
+
+def load_directories(dirs):
+    fpaths = []
+    for dir in dirs:
+        print dir
+        fpaths += [os.path.join(dir, fname) for fname in os.listdir(dir) if '.json' in fname]
+    pool = multiprocessing.Pool()
+    try:
+        results = pool.map(load_file, fpaths)
+    finally:
+        pool.close()
+        pool.join()
+    for result in results:
+        need_flatten.update(result['need_flatten'])
+        definitions.update(result['definitions'])
+
+# the libyaml emitter is much faster, the representer still calls ignore_aliases
+safe_dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+class noalias_dumper(safe_dumper):
     def ignore_aliases(self, _data):
         return True
 
-dirs = sys.argv[1:]
-for dir in dirs:
-    print dir
-    load_directory(dir)
+def write_yaml(file_handle, keys, definition):
+    # same document as yaml.dump({'definitions': {...}}), written one definition at a time
+    file_handle.write('definitions:\n')
+    for key in keys:
+        # 2 columns less wide as every line is indented by 2 below
+        text = yaml.dump({key: definition(key)}, default_flow_style=False, Dumper=noalias_dumper, width=78)
+        file_handle.write(''.join('  ' + line for line in text.splitlines(True)))
+
+def write_json(file_handle, keys, definition):
+    # same document as json.dump({'definitions': {...}}, indent=4), written one definition at a time
+    file_handle.write('{\n    "definitions": {')
+    separator = '\n'
+    for key in keys:
+        text = json.dumps(definition(key), sort_keys=True, indent=4, separators=(',', ': '))
+        file_handle.write(separator + '        ' + json.dumps(key) + ': ' + text.replace('\n', '\n        '))
+        separator = ',\n'
+    file_handle.write('\n    }\n}\n')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dirs', nargs='+', help='directories of json schema files')
+    parser.add_argument('--json', action='store_true', help='output json instead of yaml')
+    parser.add_argument('--output', default=None,
+                        help='output file, default: ./definitions.yaml or ./definitions.json')
+    args = parser.parse_args()
+    output_path = args.output or ('./definitions.json' if args.json else './definitions.yaml')
 
+    load_directories(args.dirs)
 
-with open('./definitions.yaml', 'w') as file_handle:
-    output = {}
-    for key in definitions:
-        output[key] = json.loads(json.dumps(definitions[key]), object_hook=flatten_ref)
-    
+    keys = set(definitions)
     try:
         with open('./ignore_ref.json', 'r') as ignore_refs:
             ignored = json.load(ignore_refs)
             for to_remove in ignored['ignore-ref']:
-                del output[to_remove]
+                keys.remove(to_remove)
                 print 'deleted ' + to_remove
     except:
         pass
 
-    #json.dump(output, file_handle, sort_keys=True, indent=4, separators=(',', ': '))
-    yaml_data = {}
-    yaml_data['definitions'] = output
-    file_handle.write( yaml.dump(yaml_data, default_flow_style=False, Dumper=noalias_dumper))
+    resolved = {}
+    definition = lambda key: resolve_refs(definitions[key], resolved, set())
+    with open(output_path, 'w') as file_handle:
+        if args.json:
+            write_json(file_handle, sorted(keys), definition)
+        else:
+            write_yaml(file_handle, sorted(keys), definition)